@@ -1,12 +1,34 @@
+import io
 import os
+import re
+import csv
+import gzip
 import json
+import shutil
+import bisect
+import socket
+import hashlib
+import zlib
+import struct
+import signal
+import asyncio
 import sqlite3
+import functools
+import contextlib
 import logging
-from datetime import datetime
+from collections import OrderedDict
+from time import monotonic as time_mono, time as time_wall
+from datetime import datetime, date, time, timedelta, timezone
 
 from dotenv import load_dotenv
 
+try:
+    import openpyxl  # ixtiyoriy: XLSX import uchun
+except ImportError:
+    openpyxl = None
+
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -14,12 +36,18 @@ from telegram import (
     KeyboardButton,
     ReplyKeyboardRemove,
 )
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    BasePersistence,
+    PersistenceInput,
+    Updater,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
 
@@ -29,11 +57,29 @@ TOKEN = os.getenv("BOT_TOKEN", "").strip()
 ADMIN_IDS_RAW = os.getenv("ADMIN_IDS", "").strip()
 ADMIN_PHONE = os.getenv("ADMIN_PHONE", "+998933213532").strip()
 DB_DIR = os.getenv("DB_DIR", "/data").strip()
-
-ADMIN_IDS = [int(x.strip()) for x in ADMIN_IDS_RAW.split(",") if x.strip().isdigit()]
-
-if not TOKEN or not ADMIN_IDS:
-    raise ValueError("BOT_TOKEN yoki ADMIN_IDS .env da topilmadi!")
+# eskirgan rasmni qayta yuklash uchun chat (odatda yopiq kanal); bo'sh bo'lsa birinchi admin
+MEDIA_CHAT_ID_RAW = os.getenv("MEDIA_CHAT_ID", "").strip()
+
+# Multi-worker: WORKERS>1 bo'lsa bitta qabul qiluvchi + N ta worker jarayon
+WORKERS = max(1, int(os.getenv("WORKERS", "1") or 1))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+PORT = int(os.getenv("PORT", "8080") or 8080)
+# sqlite (umumiy fayl) yoki local (bitta jarayon uchun xotirada)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite" if WORKERS > 1 else "local").strip().lower()
+
+ADMIN_ID_LIST = [int(x.strip()) for x in ADMIN_IDS_RAW.split(",") if x.strip().isdigit()]
+# har bir update da tekshiriladi — O(1) a'zolik
+ADMIN_IDS = frozenset(ADMIN_ID_LIST)
+
+# load_config() to'ldiradi: import paytida disk tekshirilmaydi, xato ko'tarilmaydi
+MEDIA_CHAT_ID = None
+WRITABLE_DIR = None
+DB_PATH = None
+BACKUP_DIR = None
+ARCHIVE_PATH = None
+
+BOOT_T0 = time_mono()
 
 # ----------------- LOG -----------------
 logging.basicConfig(level=logging.INFO)
@@ -52,55 +98,466 @@ def get_writable_dir(preferred: str) -> str:
         os.makedirs("/tmp", exist_ok=True)
         return "/tmp"
 
-WRITABLE_DIR = get_writable_dir(DB_DIR)
-DB_PATH = os.path.join(WRITABLE_DIR, "shop.db")
+def resolve_paths():
+    # bir marta: birinchi DB murojaatida yoki load_config() da
+    global WRITABLE_DIR, DB_PATH, BACKUP_DIR, ARCHIVE_PATH
+    if DB_PATH is not None:
+        return
+    WRITABLE_DIR = get_writable_dir(DB_DIR)
+    DB_PATH = os.path.join(WRITABLE_DIR, "shop.db")
+    BACKUP_DIR = os.getenv("BACKUP_DIR", "").strip() or os.path.join(WRITABLE_DIR, "backups")
+    # eski buyurtmalar shu faylga ko'chiriladi (hot DB kichik qoladi)
+    ARCHIVE_PATH = os.path.join(WRITABLE_DIR, "archive.db")
+    if WRITABLE_DIR != DB_DIR:
+        log.warning("DB_DIR (%s) ga yozib bo‘lmadi, %s ishlatilmoqda — restartda ma’lumot yo‘qolishi mumkin", DB_DIR, WRITABLE_DIR)
+
+def load_config():
+    global MEDIA_CHAT_ID
+    if not TOKEN or not ADMIN_IDS:
+        raise ValueError("BOT_TOKEN yoki ADMIN_IDS .env da topilmadi!")
+    MEDIA_CHAT_ID = int(MEDIA_CHAT_ID_RAW) if MEDIA_CHAT_ID_RAW.lstrip("-").isdigit() else ADMIN_ID_LIST[0]
+    resolve_paths()
 
 # ----------------- DB -----------------
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = conn.cursor()
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-  user_id INTEGER PRIMARY KEY,
-  name TEXT NOT NULL,
-  phone TEXT NOT NULL,
-  created_at TEXT NOT NULL
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS products (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  name TEXT NOT NULL,
-  price INTEGER NOT NULL,
-  has_sizes INTEGER NOT NULL DEFAULT 0,
-  sizes TEXT DEFAULT NULL,
-  photo_file_id TEXT DEFAULT NULL,
-  created_at TEXT NOT NULL
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS cart (
-  user_id INTEGER NOT NULL,
-  product_id INTEGER NOT NULL,
-  size TEXT DEFAULT NULL,
-  qty INTEGER NOT NULL DEFAULT 1,
-  PRIMARY KEY (user_id, product_id, size)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS orders (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id INTEGER NOT NULL,
-  items_json TEXT NOT NULL,
-  total INTEGER NOT NULL,
-  created_at TEXT NOT NULL
-)
-""")
+class Lazy:
+    # birinchi murojaatda yaratiladi: import paytida ulanish ochilmaydi
+    def __init__(self, factory):
+        self._factory = factory
+        self._obj = None
+
+    @property
+    def created(self) -> bool:
+        return self._obj is not None
+
+    def __getattr__(self, name):
+        if self._obj is None:
+            self._obj = self._factory()
+        return getattr(self._obj, name)
+
+# sxema o'zgarsa oshiriladi; joriy bo'lsa ishga tushishda DDL umuman bajarilmaydi
+SCHEMA_VERSION = 2
+
+def ensure_column(c, table: str, column: str, ddl: str):
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in {r[1] for r in c.fetchall()}:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+def create_schema(c):
+    # arch.orders — arxiv fayli (ATTACH open_db da)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS arch.orders (
+      id INTEGER PRIMARY KEY,
+      user_id INTEGER NOT NULL,
+      items_json TEXT NOT NULL,
+      total INTEGER NOT NULL,
+      created_at TEXT NOT NULL,
+      token TEXT DEFAULT NULL,
+      archived_at TEXT NOT NULL
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS arch.idx_arch_orders_created ON orders(created_at)")
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+      user_id INTEGER PRIMARY KEY,
+      name TEXT NOT NULL,
+      phone TEXT NOT NULL,
+      created_at TEXT NOT NULL
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS products (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      name TEXT NOT NULL,
+      price INTEGER NOT NULL,
+      has_sizes INTEGER NOT NULL DEFAULT 0,
+      sizes TEXT DEFAULT NULL,
+      photo_file_id TEXT DEFAULT NULL,
+      created_at TEXT NOT NULL
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS cart (
+      user_id INTEGER NOT NULL,
+      product_id INTEGER NOT NULL,
+      size TEXT DEFAULT NULL,
+      qty INTEGER NOT NULL DEFAULT 1,
+      PRIMARY KEY (user_id, product_id, size)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS orders (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER NOT NULL,
+      items_json TEXT NOT NULL,
+      total INTEGER NOT NULL,
+      created_at TEXT NOT NULL
+    )
+    """)
+
+    # Kunlik rollup: statistika orders jadvalini skan qilmasdan shu yerdan o'qiladi
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS daily_sales (
+      day TEXT PRIMARY KEY,
+      orders_count INTEGER NOT NULL DEFAULT 0,
+      revenue INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS daily_product_sales (
+      day TEXT NOT NULL,
+      name TEXT NOT NULL,
+      qty INTEGER NOT NULL DEFAULT 0,
+      revenue INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (day, name)
+    )
+    """)
+
+    # umumiy kalit-qiymat (masalan statistika versiyasi)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS meta (
+      key TEXT PRIMARY KEY,
+      value TEXT NOT NULL
+    )
+    """)
+
+    # Telegramga yuklangan grafiklar: file_id qayta ishlatiladi
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS chart_cache (
+      key TEXT PRIMARY KEY,
+      version TEXT NOT NULL,
+      file_id TEXT NOT NULL,
+      created_at TEXT NOT NULL
+    )
+    """)
+
+    # Mahsulot rasmlari reyestri: file_id tekshiriladi, kichik nusxa (thumb) saqlanadi
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS media (
+      product_id INTEGER PRIMARY KEY,
+      file_id TEXT NOT NULL,
+      thumb BLOB DEFAULT NULL,
+      ok INTEGER NOT NULL DEFAULT 1,
+      checked_at TEXT DEFAULT NULL
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_media_checked ON media(checked_at)")
+
+    # Broadcast holati: restartdan keyin cursor dan davom etadi
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS bc_jobs (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      kind TEXT NOT NULL,
+      payload TEXT NOT NULL,
+      admin_chat_id INTEGER NOT NULL,
+      cursor INTEGER NOT NULL DEFAULT 0,
+      ok INTEGER NOT NULL DEFAULT 0,
+      fail INTEGER NOT NULL DEFAULT 0,
+      status TEXT NOT NULL DEFAULT 'running',
+      created_at TEXT NOT NULL
+    )
+    """)
+
+    # Ombor qoldig'i: (mahsulot, o'lcham) bo'yicha; qator yo'q bo'lsa — cheklanmagan
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS stock (
+      product_id INTEGER NOT NULL,
+      size TEXT NOT NULL DEFAULT '-',
+      qty INTEGER NOT NULL CHECK (qty >= 0),
+      PRIMARY KEY (product_id, size)
+    )
+    """)
+
+    # migratsiyalar
+    # SKU: CSV/XLSX import shu bo'yicha upsert qiladi (wizard mahsulotlarida NULL)
+    ensure_column(c, "products", "sku", "TEXT DEFAULT NULL")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_products_sku ON products(sku) WHERE sku IS NOT NULL")
+
+    # Tasdiqlash tugmasidagi token: qayta bosish / qayta yetkazilgan update yangi buyurtma yaratmaydi
+    ensure_column(c, "orders", "token", "TEXT DEFAULT NULL")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_token ON orders(token) WHERE token IS NOT NULL")
+
+    # Tashlab ketilgan savat eslatmasi: oxirgi o'zgarish vaqti bo'yicha indeks
+    ensure_column(c, "cart", "updated_at", "TEXT DEFAULT NULL")
+    c.execute("UPDATE cart SET updated_at=? WHERE updated_at IS NULL", (datetime.utcnow().isoformat(),))
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cart_updated ON cart(updated_at, user_id)")
+
+    # Arxivga ko'chirish created_at bo'yicha tanlanadi
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)")
+
+    # har bir savat holati (oxirgi updated_at) uchun bitta eslatma
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS cart_reminders (
+      user_id INTEGER PRIMARY KEY,
+      cart_updated_at TEXT NOT NULL,
+      sent_at TEXT NOT NULL
+    )
+    """)
+
+    # Broadcast segmentlari: "X mahsulotni buyurtma qilgan" items_json ni skan qilmasdan.
+    # Arxivlashda ko'chirilmaydi — tarix hot DB da qoladi.
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS order_items (
+      product_id INTEGER NOT NULL,
+      user_id INTEGER NOT NULL,
+      order_id INTEGER NOT NULL,
+      PRIMARY KEY (product_id, user_id, order_id)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    INSERT OR IGNORE INTO order_items(product_id, user_id, order_id)
+    SELECT json_extract(j.value,'$.product_id'), o.user_id, o.id
+    FROM (SELECT id, user_id, items_json FROM main.orders
+          UNION ALL SELECT id, user_id, items_json FROM arch.orders) o,
+         json_each(o.items_json) j
+    WHERE json_valid(o.items_json) AND json_extract(j.value,'$.product_id') IS NOT NULL
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id, created_at)")
+    ensure_column(c, "bc_jobs", "segment", "TEXT DEFAULT NULL")
+
+def open_db():
+    resolve_paths()
+    t0 = time_mono()
+    # timeout: bir nechta worker yozganda "database is locked" o'rniga kutadi
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=15)
+    c = db.cursor()
+    # yangi bazada darhol kuchga kiradi; eskisi VACUUM_CONVERT=1 bilan ishga tushirilganda o'tkaziladi
+    c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL: o'qishlar yozuvni kutmaydi; shutdownda checkpoint qilinadi
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    # Arxiv: xuddi shu ulanishga biriktiriladi, ko'chirish bitta tranzaksiyada
+    c.execute("ATTACH DATABASE ? AS arch", (ARCHIVE_PATH,))
+    c.execute("PRAGMA arch.journal_mode=WAL")
+
+    def current() -> bool:
+        return (c.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+                and c.execute("PRAGMA arch.user_version").fetchone()[0] == SCHEMA_VERSION)
+
+    migrated = False
+    if not current():
+        # workerlar bir vaqtda ochsa ham sxema bir marta yoziladi
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if not current():
+                create_schema(c)
+                c.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+                c.execute(f"PRAGMA arch.user_version={SCHEMA_VERSION}")
+                migrated = True
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    log.info("DB ochildi: %s (%.1f ms, sxema v%s%s)", DB_PATH, (time_mono() - t0) * 1000,
+             SCHEMA_VERSION, " yangilandi" if migrated else "")
+    return db
+
+conn = Lazy(open_db)
+cur = Lazy(lambda: conn.cursor())
+
+# ----------------- Shared state (multi-worker) -----------------
+WORKER_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+# muddati o'tgan kv yozuvlari set() ichida shu oraliqda bir marta tozalanadi
+STORE_PURGE_EVERY = 300
+
+class LocalStore:
+    # bitta jarayon uchun stand-in: SqliteStore bilan bir xil interfeys
+    def __init__(self):
+        self._kv = {}
+        self._locks = {}
+        self._purged_at = time_mono()
+
+    def get(self, ns: str, key: str, default=None):
+        item = self._kv.get((ns, key))
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at is not None and expires_at < time_wall():
+            del self._kv[(ns, key)]
+            return default
+        return value
+
+    def set(self, ns: str, key: str, value, ttl: float | None = None):
+        self._kv[(ns, key)] = (value, time_wall() + ttl if ttl else None)
+        if time_mono() - self._purged_at > STORE_PURGE_EVERY:
+            self.purge_expired()
+
+    def purge_expired(self):
+        now = time_wall()
+        self._purged_at = time_mono()
+        for k in [k for k, (_, exp) in self._kv.items() if exp is not None and exp < now]:
+            del self._kv[k]
+
+    def delete(self, ns: str, key: str):
+        self._kv.pop((ns, key), None)
+
+    def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        now = time_wall()
+        holder = self._locks.get(name)
+        if holder and holder[0] != owner and holder[1] > now:
+            return False
+        self._locks[name] = (owner, now + ttl)
+        return True
+
+    def release_lock(self, name: str, owner: str):
+        holder = self._locks.get(name)
+        if holder and holder[0] == owner:
+            del self._locks[name]
+
+    def close(self):
+        pass
+
+class SqliteStore:
+    # barcha workerlar uchun umumiy: o'z ulanishi, autocommit, WAL
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=15, isolation_level=None)
+        # birinchi set() da eski qoldiqlar ham tozalanadi
+        self._purged_at = float("-inf")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS kv (
+              ns TEXT NOT NULL,
+              key TEXT NOT NULL,
+              value TEXT NOT NULL,
+              expires_at REAL DEFAULT NULL,
+              PRIMARY KEY (ns, key)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_kv_expires ON kv(expires_at) WHERE expires_at IS NOT NULL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS locks (
+              name TEXT PRIMARY KEY,
+              owner TEXT NOT NULL,
+              expires_at REAL NOT NULL
+            )
+        """)
+
+    def get(self, ns: str, key: str, default=None):
+        row = self.conn.execute(
+            "SELECT value FROM kv WHERE ns=? AND key=? AND (expires_at IS NULL OR expires_at>=?)",
+            (ns, key, time_wall())
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, ns: str, key: str, value, ttl: float | None = None):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO kv(ns, key, value, expires_at) VALUES (?,?,?,?)",
+            (ns, key, json.dumps(value, ensure_ascii=False), time_wall() + ttl if ttl else None)
+        )
+        if time_mono() - self._purged_at > STORE_PURGE_EVERY:
+            self.purge_expired()
+
+    def purge_expired(self):
+        # idx_kv_expires bo'yicha: faqat muddati o'tganlar o'qiladi
+        self._purged_at = time_mono()
+        self.conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at < ?", (time_wall(),))
+
+    def delete(self, ns: str, key: str):
+        self.conn.execute("DELETE FROM kv WHERE ns=? AND key=?", (ns, key))
+
+    def acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        # bitta atomar upsert: bo'sh, muddati o'tgan yoki o'zimizniki bo'lsa olamiz
+        now = time_wall()
+        c = self.conn.execute("""
+            INSERT INTO locks(name, owner, expires_at) VALUES (?,?,?)
+            ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+            WHERE locks.owner=excluded.owner OR locks.expires_at<?
+        """, (name, owner, now + ttl, now))
+        return c.rowcount > 0
+
+    def release_lock(self, name: str, owner: str):
+        self.conn.execute("DELETE FROM locks WHERE name=? AND owner=?", (name, owner))
+
+    def close(self):
+        self.conn.close()
+
+def make_store():
+    if STATE_BACKEND == "sqlite":
+        return SqliteStore(DB_PATH)
+    return LocalStore()
+
+store = Lazy(make_store)
+
+def job_lease(ttl: float):
+    # davriy job bir davrda faqat bitta workerda ishlaydi (lease qo'yib yuborilmaydi)
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(context):
+            if not store.acquire_lock(f"job:{fn.__name__}", WORKER_OWNER, ttl):
+                return None
+            return await fn(context)
+        return wrapper
+    return deco
+
+class StorePersistence(BasePersistence):
+    # faqat user_data: store da JSON. Foydalanuvchi bitta workerga bog'langan (hash ring),
+    # shuning uchun store dan faqat jarayonda birinchi marta ko'rilganda o'qiladi.
+    def __init__(self, backend, update_interval: float = 2):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.backend = backend
+        self._loaded = set()
 
-conn.commit()
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data):
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        data = self.backend.get("user_data", str(user_id))
+        if data and not user_data:
+            user_data.update(data)
+
+    async def update_user_data(self, user_id: int, data):
+        self.backend.set("user_data", str(user_id), data)
+
+    async def drop_user_data(self, user_id: int):
+        self.backend.delete("user_data", str(user_id))
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id: int, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
 
 # ----------------- Helpers -----------------
 def is_admin(user_id: int) -> bool:
@@ -109,17 +566,89 @@ def is_admin(user_id: int) -> bool:
 def money(n: int) -> str:
     return f"{n:,}".replace(",", " ")
 
+# ----------------- User cache (LRU + TTL) -----------------
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "5000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "900"))
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires < time_mono():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time_mono() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+user_cache = TTLCache(USER_CACHE_MAX, USER_CACHE_TTL)
+
 def get_user(user_id: int):
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
     cur.execute("SELECT name, phone FROM users WHERE user_id=?", (user_id,))
-    return cur.fetchone()
+    user = cur.fetchone()
+    if user:
+        user_cache.set(user_id, user)
+    return user
+
+# ----------------- Catalog cache -----------------
+# katalog xotirada; har qanday products yozuvidan keyin catalog_invalidate().
+# versiya store da — boshqa workerlar ham eskirganini bilib oladi.
+class CatalogCache:
+    def __init__(self):
+        self._rows = None
+        self._by_id = {}
+        self._version = None
+
+    def _fresh(self):
+        version = store.get("meta", "catalog_version", 0)
+        if self._rows is None or version != self._version:
+            cur.execute("SELECT id,name,price,has_sizes,sizes,photo_file_id FROM products ORDER BY id DESC")
+            self._rows = cur.fetchall()
+            self._by_id = {r[0]: r for r in self._rows}
+            self._version = version
+
+    def rows(self):
+        self._fresh()
+        return self._rows
+
+    def get(self, pid: int):
+        self._fresh()
+        return self._by_id.get(int(pid))
+
+catalog = CatalogCache()
+
+def catalog_invalidate():
+    store.set("meta", "catalog_version", int(store.get("meta", "catalog_version", 0)) + 1)
 
 def product_by_id(pid: int):
-    cur.execute("SELECT id,name,price,has_sizes,sizes,photo_file_id FROM products WHERE id=?", (pid,))
-    return cur.fetchone()
+    return catalog.get(pid)
 
 def list_products():
-    cur.execute("SELECT id,name,price,has_sizes,sizes,photo_file_id FROM products ORDER BY id DESC")
-    return cur.fetchall()
+    return catalog.rows()
 
 def cart_rows(user_id: int):
     cur.execute("""
@@ -134,6 +663,248 @@ def cart_rows(user_id: int):
 def calc_cart_total(rows):
     return sum(int(r[4]) * int(r[2]) for r in rows)
 
+# ----------------- Stock (in-memory counter) -----------------
+# bitta jarayonda barcha yozuvlar shu yerdan o'tadi — hisoblagich aniq.
+# WORKERS>1 da boshqa workerlar ham yozadi: qisqa muddatda qayta o'qiladi.
+# Haqiqiy tekshiruv baribir checkout tranzaksiyasida (BEGIN IMMEDIATE).
+STOCK_REFRESH_S = float(os.getenv("STOCK_REFRESH_S", "5" if WORKERS > 1 else "0"))
+
+class StockCounter:
+    def __init__(self):
+        self._by_pid = {}
+        self._loaded_at = None
+
+    def load(self):
+        cur.execute("SELECT product_id, size, qty FROM stock")
+        by_pid = {}
+        for pid, size, qty in cur.fetchall():
+            by_pid.setdefault(int(pid), {})[size] = int(qty)
+        self._by_pid = by_pid
+        self._loaded_at = time_mono()
+
+    def _fresh(self):
+        if self._loaded_at is None or (STOCK_REFRESH_S and time_mono() - self._loaded_at > STOCK_REFRESH_S):
+            self.load()
+
+    def for_product(self, pid: int) -> dict:
+        # {size: qty}; bo'sh dict — kuzatilmaydi (cheklanmagan)
+        self._fresh()
+        return self._by_pid.get(int(pid), {})
+
+    def available(self, pid: int, size: str | None):
+        # None — cheklanmagan
+        return self.for_product(pid).get(size or "-")
+
+    def apply(self, deltas: dict):
+        # commit dan keyin: {(pid, size): -qty}
+        for (pid, size), delta in deltas.items():
+            sizes = self._by_pid.get(int(pid))
+            if sizes is not None and size in sizes:
+                sizes[size] = max(0, sizes[size] + delta)
+
+    def set_product(self, pid: int, mapping: dict | None):
+        if mapping:
+            self._by_pid[int(pid)] = dict(mapping)
+        else:
+            self._by_pid.pop(int(pid), None)
+
+stock_counter = StockCounter()
+
+def parse_stock(text: str, has_sizes: bool, sizes: str | None):
+    # "25" yoki "10x10=5, 20x20=3"; "-" — kuzatishni o'chirish (None)
+    text = text.strip()
+    if text == "-":
+        return None
+    if not has_sizes:
+        if not text.isdigit():
+            raise ValueError("Qoldiq faqat son bo‘lishi kerak. Masalan: 25")
+        return {"-": int(text)}
+
+    known = [x.strip() for x in (sizes or "").split(",") if x.strip()]
+    mapping = {}
+    for part in text.split(","):
+        if not part.strip():
+            continue
+        if "=" not in part:
+            raise ValueError("Format: o‘lcham=son, masalan: 10x10=5, 20x20=3")
+        size, qty = [x.strip() for x in part.split("=", 1)]
+        if size not in known:
+            raise ValueError(f"Noma’lum o‘lcham: {size}. Mavjud: {', '.join(known)}")
+        if not qty.isdigit():
+            raise ValueError(f"{size} uchun son noto‘g‘ri: {qty}")
+        mapping[size] = int(qty)
+    if not mapping:
+        raise ValueError("Kamida bitta o‘lcham uchun son kiriting.")
+    # ko'rsatilmagan o'lchamlar — 0 (kuzatiladigan mahsulotda)
+    for size in known:
+        mapping.setdefault(size, 0)
+    return mapping
+
+def set_stock(pid: int, mapping: dict | None):
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("DELETE FROM stock WHERE product_id=?", (pid,))
+        if mapping:
+            cur.executemany(
+                "INSERT INTO stock(product_id, size, qty) VALUES (?,?,?)",
+                [(pid, size, qty) for size, qty in mapping.items()]
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    stock_counter.set_product(pid, mapping)
+
+def stock_text(pid: int) -> str:
+    sizes = stock_counter.for_product(pid)
+    if not sizes:
+        return ""
+    if list(sizes) == ["-"]:
+        return f"📦 Omborda: {sizes['-']} dona"
+    return "📦 Omborda: " + ", ".join(f"{s} — {q}" for s, q in sizes.items())
+
+# ----------------- Sales rollups (daily_sales) -----------------
+def rollup_add_order(created_at: str, items: list, total: int):
+    # commit chaqiruvchi tomonda: buyurtma INSERT bilan bitta tranzaksiyada
+    day = created_at[:10]
+    cur.execute("""
+        INSERT INTO daily_sales(day, orders_count, revenue) VALUES (?,1,?)
+        ON CONFLICT(day) DO UPDATE SET
+          orders_count=orders_count+1,
+          revenue=revenue+excluded.revenue
+    """, (day, int(total)))
+    cur.executemany("""
+        INSERT INTO daily_product_sales(day, name, qty, revenue) VALUES (?,?,?,?)
+        ON CONFLICT(day, name) DO UPDATE SET
+          qty=qty+excluded.qty,
+          revenue=revenue+excluded.revenue
+    """, [
+        (day, it.get("name", "Unknown"), int(it.get("qty", 1)),
+         int(it.get("price", 0)) * int(it.get("qty", 1)))
+        for it in items
+    ])
+    bump_stats_version()
+
+# tungi tekshiruv faqat oxirgi kunlarni qayta hisoblaydi; to'liq — bootstrap / qo'lda
+ROLLUP_RECHECK_DAYS = 3
+
+def rebuild_rollups(since: str | None = None):
+    # orders (hot + arxiv) dan qayta hisoblash: since (YYYY-MM-DD) dan boshlab, None — to'liq.
+    # alohida ulanishda (asyncio.to_thread): event loop va umumiy conn band qilinmaydi.
+    # ko'chirish orasida ikkala faylda turgan buyurtma bir marta (hot dan) sanaladi.
+    day_from = since or ""
+    c = sqlite3.connect(DB_PATH, timeout=15)
+    try:
+        c.execute("ATTACH DATABASE ? AS arch", (ARCHIVE_PATH,))
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            _rebuild_rollups(c.cursor(), day_from)
+            c.commit()
+        except Exception:
+            c.rollback()
+            raise
+    finally:
+        c.close()
+
+def _rebuild_rollups(c, day_from: str):
+    # created_at >= day_from — idx_orders_created / idx_arch_orders_created bo'yicha
+    c.execute("DELETE FROM daily_sales WHERE day >= ?", (day_from,))
+    c.execute("DELETE FROM daily_product_sales WHERE day >= ?", (day_from,))
+    c.execute("""
+        INSERT INTO daily_sales(day, orders_count, revenue)
+        SELECT substr(created_at,1,10), COUNT(*), COALESCE(SUM(total),0)
+        FROM (SELECT created_at, total FROM main.orders WHERE created_at >= :d
+              UNION ALL SELECT created_at, total FROM arch.orders a
+              WHERE a.created_at >= :d AND NOT EXISTS (SELECT 1 FROM main.orders m WHERE m.id=a.id))
+        GROUP BY substr(created_at,1,10)
+    """, {"d": day_from})
+    c.execute("""
+        INSERT INTO daily_product_sales(day, name, qty, revenue)
+        SELECT substr(o.created_at,1,10),
+               COALESCE(json_extract(j.value,'$.name'),'Unknown'),
+               SUM(COALESCE(json_extract(j.value,'$.qty'),1)),
+               SUM(COALESCE(json_extract(j.value,'$.price'),0) * COALESCE(json_extract(j.value,'$.qty'),1))
+        FROM (SELECT created_at, items_json FROM main.orders WHERE created_at >= :d
+              UNION ALL SELECT created_at, items_json FROM arch.orders a
+              WHERE a.created_at >= :d AND NOT EXISTS (SELECT 1 FROM main.orders m WHERE m.id=a.id)) o,
+             json_each(o.items_json) j
+        WHERE json_valid(o.items_json)
+        GROUP BY 1, 2
+    """, {"d": day_from})
+    bump_stats_version(c)
+
+def bump_stats_version(c=None):
+    # rollup o'zgarganda oshadi — grafik keshi shu versiyaga bog'langan
+    (c or cur).execute("""
+        INSERT INTO meta(key, value) VALUES ('stats_version', '1')
+        ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER)+1
+    """)
+
+def stats_version() -> str:
+    cur.execute("SELECT value FROM meta WHERE key='stats_version'")
+    row = cur.fetchone()
+    return row[0] if row else "0"
+
+def sales_days(start: date, end: date) -> dict:
+    cur.execute(
+        "SELECT day, orders_count, revenue FROM daily_sales WHERE day BETWEEN ? AND ?",
+        (start.isoformat(), end.isoformat())
+    )
+    return {d: (int(c), int(r)) for d, c, r in cur.fetchall()}
+
+def bucket_start(d: date, period: str) -> date:
+    if period == "week":
+        return d - timedelta(days=d.weekday())
+    if period == "month":
+        return d.replace(day=1)
+    return d
+
+def prev_bucket(start: date, period: str) -> date:
+    if period == "week":
+        return start - timedelta(days=7)
+    if period == "month":
+        return (start - timedelta(days=1)).replace(day=1)
+    return start - timedelta(days=1)
+
+STATS_PERIODS = {
+    # period: (sarlavha, nechta bucket)
+    "day": ("Kunlik", 14),
+    "week": ("Haftalik", 8),
+    "month": ("Oylik", 6),
+}
+
+def sales_buckets(period: str, count: int, today: date | None = None):
+    # oxirgi `count` ta bucket + bitta oldingisi (birinchi bucket ham taqqoslansin)
+    # natija: [(start, orders, revenue), ...] eskidan yangiga
+    today = today or datetime.now(timezone.utc).date()
+    starts = [bucket_start(today, period)]
+    for _ in range(count):
+        starts.append(prev_bucket(starts[-1], period))
+    starts.reverse()
+
+    days = sales_days(starts[0], today)
+    totals = {s: [0, 0] for s in starts}
+    for day, (c, r) in days.items():
+        s = bucket_start(date.fromisoformat(day), period)
+        if s in totals:
+            totals[s][0] += c
+            totals[s][1] += r
+    return [(s, totals[s][0], totals[s][1]) for s in starts]
+
+def bucket_label(start: date, period: str) -> str:
+    if period == "week":
+        return f"{start.isocalendar()[1]:02d}-hafta ({start:%m.%d})"
+    if period == "month":
+        return f"{start:%Y-%m}"
+    return f"{start:%m.%d}"
+
+def pct_change(cur_value: int, prev_value: int) -> str:
+    if prev_value <= 0:
+        return "—" if cur_value <= 0 else "🆕"
+    diff = (cur_value - prev_value) * 100 / prev_value
+    arrow = "🔺" if diff > 0 else ("🔻" if diff < 0 else "➖")
+    return f"{arrow}{diff:+.0f}%"
+
 def ensure_nav(context: ContextTypes.DEFAULT_TYPE):
     if "nav" not in context.user_data or not isinstance(context.user_data["nav"], list):
         context.user_data["nav"] = []
@@ -159,6 +930,7 @@ def clear_state(context: ContextTypes.DEFAULT_TYPE):
         "tmp_name", "tmp_price", "tmp_has_sizes", "tmp_sizes",
         "edit_pid",
         "pending_pid", "pending_size", "pending_origin",
+        "bc_segment",
     ]
     for k in keys:
         context.user_data.pop(k, None)
@@ -185,8 +957,11 @@ def admin_panel_inline() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("➕ Mahsulot qo‘shish", callback_data="A_ADD")],
         [InlineKeyboardButton("📦 Mahsulotlarni boshqarish", callback_data="A_MANAGE")],
+        [InlineKeyboardButton("📥 Import (CSV/XLSX)", callback_data="A_IMPORT")],
         [InlineKeyboardButton("📢 Broadcast", callback_data="A_BC")],
         [InlineKeyboardButton("📊 Statistika", callback_data="A_STATS")],
+        [InlineKeyboardButton("💾 Backup", callback_data="A_BK"),
+         InlineKeyboardButton("🗄 Buyurtmalar CSV", callback_data="A_EXPORT")],
     ])
 
 def back_btn() -> InlineKeyboardMarkup:
@@ -210,9 +985,12 @@ A_EDIT_NAME = "A_EDIT_NAME"
 A_EDIT_PRICE = "A_EDIT_PRICE"
 A_EDIT_SIZES = "A_EDIT_SIZES"
 A_EDIT_PHOTO = "A_EDIT_PHOTO"
+A_EDIT_STOCK = "A_EDIT_STOCK"
 
 A_BC_TEXT = "A_BC_TEXT"
 
+A_IMPORT_FILE = "A_IMPORT_FILE"
+
 # ----------------- Commands -----------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -266,6 +1044,7 @@ async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         (uid, name, phone, now)
     )
     conn.commit()
+    user_cache.set(uid, (name, phone))
 
     clear_state(context)
     # muhim: contact tugmasi qolib ketmasin
@@ -308,6 +1087,17 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Xatolik. Qaytadan urinib ko‘ring.", reply_markup=main_menu_kb(False))
             return
 
+        avail = stock_counter.available(int(pid), size)
+        if avail is not None and cart_qty(uid, int(pid), size) + qty > avail:
+            in_cart = cart_qty(uid, int(pid), size)
+            left = max(0, avail - in_cart)
+            await update.message.reply_text(
+                f"❌ Omborda yetarli emas. Yana {left} dona qo‘shish mumkin"
+                + (f" (savatchada {in_cart} ta bor)." if in_cart else "."),
+                reply_markup=back_btn()
+            )
+            return
+
         await cart_add_qty(uid, int(pid), size, qty)
         clear_state(context)
 
@@ -399,13 +1189,22 @@ async def show_product_detail(q_or_msg, context: ContextTypes.DEFAULT_TYPE, pid:
     else:
         caption += "📐 O‘lchamsiz\n\nSavatchaga qo‘shish uchun davom eting 👇 (keyin sonini kiritasiz)"
 
+    st = stock_text(pid)
+    if st:
+        caption += f"\n{st}"
+
     caption += f"\n\n📞 Aloqa: {ADMIN_PHONE}"
 
     kb = []
 
     if has_sizes and sizes:
         for s in [x.strip() for x in sizes.split(",") if x.strip()]:
-            kb.append([InlineKeyboardButton(f"📐 {s}", callback_data=f"U_SIZE|{pid}|{s}|{origin}")])
+            if stock_counter.available(pid, s) == 0:
+                kb.append([InlineKeyboardButton(f"❌ {s} (tugagan)", callback_data="noop")])
+            else:
+                kb.append([InlineKeyboardButton(f"📐 {s}", callback_data=f"U_SIZE|{pid}|{s}|{origin}")])
+    elif stock_counter.available(pid, "-") == 0:
+        kb.append([InlineKeyboardButton("❌ Tugagan", callback_data="noop")])
     else:
         kb.append([InlineKeyboardButton("➕ Savatchaga", callback_data=f"U_SIZE|{pid}|-|{origin}")])
 
@@ -417,30 +1216,150 @@ async def show_product_detail(q_or_msg, context: ContextTypes.DEFAULT_TYPE, pid:
 
     if photo_id:
         # yangi detail post
-        if hasattr(q_or_msg, "message"):
-            await q_or_msg.message.reply_photo(photo=photo_id, caption=caption, reply_markup=InlineKeyboardMarkup(kb))
-        else:
-            await q_or_msg.reply_photo(photo=photo_id, caption=caption, reply_markup=InlineKeyboardMarkup(kb))
+        target = q_or_msg.message if hasattr(q_or_msg, "message") else q_or_msg
+        sent = await send_product_photo(target, pid, photo_id, caption, InlineKeyboardMarkup(kb))
+        if not sent:
+            await target.reply_text(caption, reply_markup=InlineKeyboardMarkup(kb))
     else:
         if hasattr(q_or_msg, "message"):
             await q_or_msg.message.reply_text(caption, reply_markup=InlineKeyboardMarkup(kb))
         else:
             await q_or_msg.reply_text(caption, reply_markup=InlineKeyboardMarkup(kb))
 
-# ----------------- Cart: list (1 post) -----------------
-async def show_cart_list(update_or_qmsg, context: ContextTypes.DEFAULT_TYPE, push: bool):
-    uid = update_or_qmsg.from_user.id if hasattr(update_or_qmsg, "from_user") else update_or_qmsg.effective_user.id
-    rows = cart_rows(uid)
-    if not rows:
-        if hasattr(update_or_qmsg, "message"):
-            await update_or_qmsg.message.reply_text("🛒 Savatcha bo‘sh.", reply_markup=back_btn())
-        else:
-            await update_or_qmsg.reply_text("🛒 Savatcha bo‘sh.", reply_markup=back_btn())
-        return
+# ----------------- Media registry (photo file_id) -----------------
+MEDIA_THUMB_MAX_SIDE = 800
+MEDIA_CHECK_BATCH = 50
+MEDIA_CHECK_EVERY_H = 24
 
-    if push:
-        nav_push(context, "CART", {})
+def pick_thumb(photo_sizes):
+    # eng katta, lekin MEDIA_THUMB_MAX_SIDE dan oshmaydigan o'lcham
+    fitting = [p for p in photo_sizes if max(p.width, p.height) <= MEDIA_THUMB_MAX_SIDE]
+    return fitting[-1] if fitting else photo_sizes[0]
+
+async def download_file_bytes(bot, file_id: str) -> bytes | None:
+    try:
+        f = await bot.get_file(file_id)
+        return bytes(await f.download_as_bytearray())
+    except Exception:
+        log.warning("Faylni yuklab bo'lmadi: %s", file_id)
+        return None
+
+def media_row(pid: int):
+    cur.execute("SELECT file_id, thumb FROM media WHERE product_id=?", (pid,))
+    return cur.fetchone()
+
+def media_save(pid: int, file_id: str, thumb: bytes | None = None):
+    now = datetime.utcnow().isoformat()
+    cur.execute("""
+        INSERT INTO media(product_id, file_id, thumb, ok, checked_at) VALUES (?,?,?,1,?)
+        ON CONFLICT(product_id) DO UPDATE SET
+          file_id=excluded.file_id,
+          thumb=COALESCE(excluded.thumb, media.thumb),
+          ok=1,
+          checked_at=excluded.checked_at
+    """, (pid, file_id, thumb, now))
+    cur.execute("UPDATE products SET photo_file_id=? WHERE id=?", (file_id, pid))
+    conn.commit()
+    catalog_invalidate()
+
+async def media_register(bot, pid: int, photo_sizes):
+    # admin rasm yuklaganda: file_id + lokal thumb
+    file_id = photo_sizes[-1].file_id
+    thumb = await download_file_bytes(bot, pick_thumb(photo_sizes).file_id)
+    media_save(pid, file_id, thumb)
+
+async def media_reupload(bot, pid: int, thumb: bytes) -> str | None:
+    # saqlangan baytlardan qayta yuklab, yangi file_id ni olamiz
+    try:
+        msg = await bot.send_photo(MEDIA_CHAT_ID, photo=thumb, disable_notification=True)
+    except Exception:
+        log.exception("Rasmni qayta yuklab bo'lmadi (product=%s)", pid)
+        return None
+    new_id = msg.photo[-1].file_id
+    media_save(pid, new_id)
+    try:
+        await msg.delete()
+    except Exception:
+        pass
+    return new_id
+
+async def send_product_photo(target, pid: int, photo_id: str, caption: str, markup) -> bool:
+    try:
+        await target.reply_photo(photo=photo_id, caption=caption, reply_markup=markup)
+        return True
+    except BadRequest:
+        log.warning("Eskirgan photo file_id (product=%s), thumbdan qayta yuklanadi", pid)
+
+    row = media_row(pid)
+    if not row or not row[1]:
+        cur.execute("UPDATE media SET ok=0 WHERE product_id=?", (pid,))
+        conn.commit()
+        return False
+
+    # bir marta: foydalanuvchiga baytlarni yuboramiz va yangi id ni saqlaymiz
+    try:
+        msg = await target.reply_photo(photo=bytes(row[1]), caption=caption, reply_markup=markup)
+    except Exception:
+        log.exception("Thumbdan yuborib bo'lmadi (product=%s)", pid)
+        return False
+    media_save(pid, msg.photo[-1].file_id)
+    return True
+
+@job_lease(ttl=300)
+async def media_check_job(context: ContextTypes.DEFAULT_TYPE):
+    # eng uzoq tekshirilmagan file_id larni partiyalab tekshiradi
+    bot = context.bot
+    cutoff = (datetime.utcnow() - timedelta(hours=MEDIA_CHECK_EVERY_H)).isoformat()
+    cur.execute("""
+        SELECT product_id, file_id, thumb IS NOT NULL FROM media
+        WHERE checked_at IS NULL OR checked_at < ?
+        ORDER BY checked_at IS NOT NULL, checked_at
+        LIMIT ?
+    """, (cutoff, MEDIA_CHECK_BATCH))
+    rows = cur.fetchall()
+
+    refreshed, broken = 0, 0
+    for pid, file_id, has_thumb in rows:
+        now = datetime.utcnow().isoformat()
+        try:
+            await bot.get_file(file_id)
+        except BadRequest:
+            row = media_row(pid)
+            if row and row[1] and await media_reupload(bot, pid, bytes(row[1])):
+                refreshed += 1
+            else:
+                cur.execute("UPDATE media SET ok=0, checked_at=? WHERE product_id=?", (now, pid))
+                conn.commit()
+                broken += 1
+            continue
+        except Exception:
+            # tarmoq xatosi — keyingi safar
+            continue
+
+        thumb = None
+        if not has_thumb:
+            thumb = await download_file_bytes(bot, file_id)
+        cur.execute(
+            "UPDATE media SET ok=1, checked_at=?, thumb=COALESCE(?, thumb) WHERE product_id=?",
+            (now, thumb, pid)
+        )
+        conn.commit()
 
+    if rows:
+        log.info("Media tekshiruv: %s ta, yangilandi %s, buzuq %s", len(rows), refreshed, broken)
+
+def media_warmup():
+    # reyestrda yo'q eski mahsulot rasmlari (thumbsiz) — keyin job to'ldiradi
+    cur.execute("""
+        INSERT OR IGNORE INTO media(product_id, file_id)
+        SELECT id, photo_file_id FROM products
+        WHERE photo_file_id IS NOT NULL AND photo_file_id <> ''
+    """)
+    conn.commit()
+
+# ----------------- Cart: list (1 post) -----------------
+def render_cart(rows):
+    # savatcha posti: (matn, tugmalar) — show_cart_list va eslatmalar uchun
     total = calc_cart_total(rows)
     lines = ["🛒 Savatcha ro‘yxati:"]
     kb = []
@@ -455,17 +1374,41 @@ async def show_cart_list(update_or_qmsg, context: ContextTypes.DEFAULT_TYPE, pus
 
     lines.append(f"\n💰 Jami: {money(total)} so'm")
 
-    kb.append([InlineKeyboardButton("✅ Buyurtmani tasdiqlash", callback_data="U_CONFIRM")])
+    kb.append([InlineKeyboardButton("✅ Buyurtmani tasdiqlash", callback_data=f"U_CONFIRM|{os.urandom(6).hex()}")])
     kb.append([InlineKeyboardButton("🧹 Savatchani tozalash", callback_data="U_CLEAR_CART")])
     kb.append([InlineKeyboardButton("⬅️ Orqaga", callback_data="U_BACK")])
 
-    text = "\n".join(lines)
+    return "\n".join(lines), InlineKeyboardMarkup(kb)
+
+async def show_cart_list(update_or_qmsg, context: ContextTypes.DEFAULT_TYPE, push: bool):
+    uid = update_or_qmsg.from_user.id if hasattr(update_or_qmsg, "from_user") else update_or_qmsg.effective_user.id
+    rows = cart_rows(uid)
+    if not rows:
+        if hasattr(update_or_qmsg, "message"):
+            await update_or_qmsg.message.reply_text("🛒 Savatcha bo‘sh.", reply_markup=back_btn())
+        else:
+            await update_or_qmsg.reply_text("🛒 Savatcha bo‘sh.", reply_markup=back_btn())
+        return
+
+    if push:
+        nav_push(context, "CART", {})
+
+    text, markup = render_cart(rows)
     if hasattr(update_or_qmsg, "message"):
-        await update_or_qmsg.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
+        await update_or_qmsg.message.reply_text(text, reply_markup=markup)
     else:
-        await update_or_qmsg.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
+        await update_or_qmsg.reply_text(text, reply_markup=markup)
 
 # ----------------- Cart DB operations (qty manual) -----------------
+def cart_qty(user_id: int, product_id: int, size: str) -> int:
+    size_val = None if size == "-" else size
+    cur.execute("""
+        SELECT qty FROM cart
+        WHERE user_id=? AND product_id=? AND COALESCE(size,'-')=COALESCE(?, '-')
+    """, (user_id, product_id, size_val))
+    row = cur.fetchone()
+    return int(row[0]) if row else 0
+
 async def cart_add_qty(user_id: int, product_id: int, size: str, qty_to_add: int):
     size_val = None if size == "-" else size
 
@@ -475,45 +1418,196 @@ async def cart_add_qty(user_id: int, product_id: int, size: str, qty_to_add: int
     """, (user_id, product_id, size_val))
     row = cur.fetchone()
 
+    now = datetime.utcnow().isoformat()
     if row:
         cur.execute("""
-            UPDATE cart SET qty=qty+?
+            UPDATE cart SET qty=qty+?, updated_at=?
             WHERE user_id=? AND product_id=? AND COALESCE(size,'-')=COALESCE(?, '-')
-        """, (qty_to_add, user_id, product_id, size_val))
+        """, (qty_to_add, now, user_id, product_id, size_val))
     else:
-        cur.execute("INSERT INTO cart(user_id,product_id,size,qty) VALUES (?,?,?,?)",
-                    (user_id, product_id, size_val, qty_to_add))
+        cur.execute("INSERT INTO cart(user_id,product_id,size,qty,updated_at) VALUES (?,?,?,?,?)",
+                    (user_id, product_id, size_val, qty_to_add, now))
+    conn.commit()
+
+# ----------------- Abandoned cart reminders -----------------
+CART_REMIND_HOURS = float(os.getenv("CART_REMIND_HOURS", "24"))
+CART_REMIND_BATCH = 200
+CART_REMIND_RATE = 20  # xabar/soniya (Telegram umumiy limiti ~30)
+
+def meta_get(key: str, default=None):
+    cur.execute("SELECT value FROM meta WHERE key=?", (key,))
+    row = cur.fetchone()
+    return json.loads(row[0]) if row else default
+
+def meta_set(key: str, value):
+    cur.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?,?)", (key, json.dumps(value)))
     conn.commit()
 
+def abandoned_cart_batch(cursor, cutoff: str, limit: int):
+    # idx_cart_updated bo'yicha (updated_at, user_id) > cursor oralig'i — butun jadval skan qilinmaydi
+    # (row-value: OR bilan yozilsa SQLite cursor ni indeks chegarasi sifatida ishlatmaydi)
+    last_at, last_uid = cursor
+    cur.execute("""
+        SELECT user_id, updated_at FROM cart
+        WHERE (updated_at, user_id) > (?, ?) AND updated_at <= ?
+        ORDER BY updated_at, user_id
+        LIMIT ?
+    """, (last_at, last_uid, cutoff, limit))
+    return cur.fetchall()
+
+def cart_reminder_due(uid: int, updated_at: str) -> bool:
+    # shu qator foydalanuvchining eng oxirgi o'zgarishi bo'lsin va bu holatga eslatilmagan bo'lsin
+    cur.execute("SELECT MAX(updated_at) FROM cart WHERE user_id=?", (uid,))
+    if cur.fetchone()[0] != updated_at:
+        return False
+    cur.execute("SELECT cart_updated_at FROM cart_reminders WHERE user_id=?", (uid,))
+    row = cur.fetchone()
+    return not row or row[0] < updated_at
+
+@job_lease(ttl=300)
+async def cart_reminder_job(context: ContextTypes.DEFAULT_TYPE):
+    cutoff = (datetime.utcnow() - timedelta(hours=CART_REMIND_HOURS)).isoformat()
+    cursor = meta_get("cart_remind_cursor", ["", 0])
+    rows = abandoned_cart_batch(cursor, cutoff, CART_REMIND_BATCH)
+    if not rows:
+        return
+
+    sent = 0
+    handled = set()
+    for uid, updated_at in rows:
+        if lifecycle.stopping.is_set():
+            break
+        cursor = [updated_at, uid]
+        if uid in handled or not cart_reminder_due(uid, updated_at):
+            continue
+        handled.add(uid)
+
+        cart = cart_rows(uid)
+        if not cart:
+            continue
+        text, markup = render_cart(cart)
+        try:
+            await context.bot.send_message(
+                uid, "🛒 Savatchangizda mahsulotlar qoldi!\n\n" + text, reply_markup=markup
+            )
+            sent += 1
+        except Exception:
+            pass
+        # yuborilmasa ham (bloklagan) qayta urinilmaydi
+        cur.execute(
+            "INSERT OR REPLACE INTO cart_reminders(user_id, cart_updated_at, sent_at) VALUES (?,?,?)",
+            (uid, updated_at, datetime.utcnow().isoformat())
+        )
+        meta_set("cart_remind_cursor", cursor)
+        await asyncio.sleep(1 / CART_REMIND_RATE)
+
+    meta_set("cart_remind_cursor", cursor)
+    log.info("Savat eslatmalari: %s ta yuborildi (cursor=%s)", sent, cursor)
+
 # ----------------- Order confirm -----------------
-async def confirm_order(user_id: int, context: ContextTypes.DEFAULT_TYPE, reply_target):
+class KeyedLocks:
+    # kalit bo'yicha asyncio.Lock; hech kim kutmasa o'chiriladi
+    def __init__(self):
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+confirm_locks = KeyedLocks()
+
+def order_by_token(token: str):
+    cur.execute("SELECT id, total FROM orders WHERE token=?", (token,))
+    return cur.fetchone()
+
+async def confirm_order(user_id: int, context: ContextTypes.DEFAULT_TYPE, reply_target, token: str | None = None):
+    # bitta foydalanuvchining tasdiqlari navbat bilan; token bo'yicha takror tekshiriladi
+    async with confirm_locks.hold(user_id):
+        await _confirm_order(user_id, context, reply_target, token)
+
+async def _confirm_order(user_id: int, context: ContextTypes.DEFAULT_TYPE, reply_target, token: str | None):
     user = get_user(user_id)
     if not user:
         await reply_target.reply_text("❗ Avval /start qilib ro‘yxatdan o‘ting.", reply_markup=back_btn())
         return
 
-    rows = cart_rows(user_id)
-    if not rows:
-        await reply_target.reply_text("🛒 Savatcha bo‘sh.", reply_markup=back_btn())
-        return
+    # qoldiqni band qilish + buyurtma + savatni tozalash — bitta yozuv tranzaksiyasi
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        existing = order_by_token(token) if token else None
+        if existing:
+            conn.rollback()
+            await reply_target.reply_text(
+                f"✅ Buyurtma #{existing[0]} allaqachon qabul qilingan ({money(existing[1])} so'm).",
+                reply_markup=back_btn()
+            )
+            return
 
-    total = calc_cart_total(rows)
-    items = []
-    lines = []
+        rows = cart_rows(user_id)
+        if not rows:
+            conn.rollback()
+            await reply_target.reply_text("🛒 Savatcha bo‘sh.", reply_markup=back_btn())
+            return
 
-    for (pid, size, qty, name, price) in rows:
-        items.append({"product_id": pid, "name": name, "size": None if size == "-" else size,
-                      "qty": qty, "price": price})
-        size_txt = f" ({size})" if size != "-" else ""
-        lines.append(f"• {name}{size_txt} × {qty} = {money(price*qty)} so'm")
+        total = calc_cart_total(rows)
+        items = []
+        lines = []
+        deltas = {}
+        shortages = []
+
+        for (pid, size, qty, name, price) in rows:
+            items.append({"product_id": pid, "name": name, "size": None if size == "-" else size,
+                          "qty": qty, "price": price})
+            size_txt = f" ({size})" if size != "-" else ""
+            lines.append(f"• {name}{size_txt} × {qty} = {money(price*qty)} so'm")
+
+            cur.execute(
+                "UPDATE stock SET qty=qty-? WHERE product_id=? AND size=? AND qty>=?",
+                (qty, pid, size, qty)
+            )
+            if cur.rowcount:
+                deltas[(pid, size)] = -int(qty)
+            else:
+                cur.execute("SELECT qty FROM stock WHERE product_id=? AND size=?", (pid, size))
+                row = cur.fetchone()
+                if row is not None:
+                    shortages.append(f"• {name}{size_txt}: omborda {row[0]} ta")
+
+        if shortages:
+            conn.rollback()
+            stock_counter.load()
+            await reply_target.reply_text(
+                "❌ Ba’zi mahsulotlar omborda yetarli emas:\n" + "\n".join(shortages)
+                + "\n\nSavatchani o‘zgartirib, qayta tasdiqlang.",
+                reply_markup=back_btn()
+            )
+            return
 
-    now = datetime.utcnow().isoformat()
-    cur.execute(
-        "INSERT INTO orders(user_id, items_json, total, created_at) VALUES (?,?,?,?)",
-        (user_id, json.dumps(items, ensure_ascii=False), int(total), now)
-    )
-    cur.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
-    conn.commit()
+        now = datetime.utcnow().isoformat()
+        cur.execute(
+            "INSERT INTO orders(user_id, items_json, total, created_at, token) VALUES (?,?,?,?,?)",
+            (user_id, json.dumps(items, ensure_ascii=False), int(total), now, token)
+        )
+        order_id = cur.lastrowid
+        cur.executemany(
+            "INSERT OR IGNORE INTO order_items(product_id, user_id, order_id) VALUES (?,?,?)",
+            [(it["product_id"], user_id, order_id) for it in items]
+        )
+        cur.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
+        rollup_add_order(now, items, int(total))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    stock_counter.apply(deltas)
 
     await reply_target.reply_text("✅ Buyurtma qabul qilindi! Tez orada siz bilan bog‘lanamiz.", reply_markup=back_btn())
 
@@ -542,6 +1636,9 @@ async def admin_manage_products(q, context: ContextTypes.DEFAULT_TYPE):
     for (pid, name, price, has_sizes, sizes, photo_id) in products:
         sz = sizes if (has_sizes and sizes) else "o‘lchamsiz"
         text = f"#{pid} • {name}\n💰 {money(price)} so'm\n📐 {sz}"
+        st = stock_text(pid)
+        if st:
+            text += f"\n{st}"
         markup = InlineKeyboardMarkup([
             [InlineKeyboardButton("✏️ Tahrirlash", callback_data=f"A_EDIT|{pid}")],
             [InlineKeyboardButton("❌ O‘chirish", callback_data=f"A_DEL_DO|{pid}")],
@@ -549,38 +1646,572 @@ async def admin_manage_products(q, context: ContextTypes.DEFAULT_TYPE):
         ])
         await q.message.reply_text(text, reply_markup=markup)
 
+# ----------------- Admin import (CSV/XLSX) -----------------
+IMPORT_MAX_BYTES = 10 * 1024 * 1024
+IMPORT_TTL = 1800
+IMPORT_PREVIEW_LINES = 12
+
+IMPORT_COLUMNS = {
+    "sku": ("sku", "artikul", "kod"),
+    "name": ("name", "nomi", "nom"),
+    "price": ("price", "narx", "narxi"),
+    "sizes": ("sizes", "olcham", "olchamlar"),
+    "stock": ("stock", "qoldiq"),
+}
+
+def _norm_header(h: str) -> str:
+    return "".join(ch for ch in str(h).strip().lower() if ch.isalnum() or ch == "_")
+
+def read_table(filename: str, data: bytes) -> list:
+    if filename.lower().endswith(".xlsx"):
+        if openpyxl is None:
+            raise ValueError("XLSX uchun openpyxl o‘rnatilmagan. CSV yuboring.")
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            return [
+                ["" if v is None else str(v) for v in row]
+                for row in wb.active.iter_rows(values_only=True)
+            ]
+        finally:
+            wb.close()
+
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = data.decode("cp1251")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    return list(csv.reader(io.StringIO(text), dialect))
+
+def parse_price(value: str):
+    v = str(value).replace(" ", "").replace("\xa0", "")
+    if v.endswith(".0"):
+        v = v[:-2]
+    return int(v) if v.isdigit() else None
+
+def parse_import(rows: list):
+    # natija: (items, errors); items — JSON ga yaroqli dict lar
+    if not rows:
+        raise ValueError("Fayl bo‘sh.")
+    header = [_norm_header(h) for h in rows[0]]
+    idx = {}
+    for key, aliases in IMPORT_COLUMNS.items():
+        for i, h in enumerate(header):
+            if h in aliases:
+                idx[key] = i
+                break
+    missing = [k for k in ("sku", "name", "price") if k not in idx]
+    if missing:
+        raise ValueError("Ustunlar topilmadi: " + ", ".join(missing) + ". Kerakli: sku, name, price [, sizes, stock]")
+
+    def cell(r, key):
+        i = idx.get(key)
+        return r[i].strip() if i is not None and i < len(r) and r[i] is not None else ""
+
+    items, errors, seen = [], [], set()
+    for n, r in enumerate(rows[1:], start=2):
+        if not any(str(c).strip() for c in r):
+            continue
+        sku, name = cell(r, "sku"), cell(r, "name")
+        if sku.endswith(".0") and sku[:-2].isdigit():
+            sku = sku[:-2]
+        price = parse_price(cell(r, "price"))
+        if not sku or len(name) < 2 or price is None:
+            errors.append(f"{n}-qator: sku/nom/narx noto‘g‘ri")
+            continue
+        if sku in seen:
+            errors.append(f"{n}-qator: {sku} takrorlangan")
+            continue
+        seen.add(sku)
+
+        sizes_list = [x.strip() for x in cell(r, "sizes").split(",") if x.strip()]
+        sizes = ", ".join(sizes_list) if sizes_list else None
+        item = {"sku": sku, "name": name, "price": price, "has_sizes": 1 if sizes else 0, "sizes": sizes}
+
+        stock_raw = cell(r, "stock")
+        if stock_raw.endswith(".0") and stock_raw[:-2].isdigit():
+            stock_raw = stock_raw[:-2]
+        if stock_raw:
+            try:
+                item["stock"] = parse_stock(stock_raw, bool(sizes), sizes)
+            except ValueError as e:
+                errors.append(f"{n}-qator ({sku}): {e}")
+                continue
+        items.append(item)
+    return items, errors
+
+def import_diff(items: list):
+    cur.execute("SELECT id, sku, name, price, sizes FROM products WHERE sku IS NOT NULL")
+    existing = {r[1]: r for r in cur.fetchall()}
+    new, changed, same = [], [], 0
+    for it in items:
+        ex = existing.get(it["sku"])
+        if not ex:
+            new.append(f"🆕 {it['sku']}: {it['name']} — {money(it['price'])}")
+            continue
+        pid, _, name, price, sizes = ex
+        diffs = []
+        if name != it["name"]:
+            diffs.append(f"nom «{name}» → «{it['name']}»")
+        if int(price) != it["price"]:
+            diffs.append(f"narx {money(price)} → {money(it['price'])}")
+        if (sizes or None) != it["sizes"]:
+            diffs.append(f"o‘lcham {sizes or '-'} → {it['sizes'] or '-'}")
+        if "stock" in it and (stock_counter.for_product(pid) or None) != it["stock"]:
+            diffs.append("qoldiq")
+        if diffs:
+            changed.append(f"✏️ {it['sku']}: " + "; ".join(diffs))
+        else:
+            same += 1
+    return new, changed, same
+
+def apply_import(items: list):
+    now = datetime.utcnow().isoformat()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("SELECT sku, sizes FROM products WHERE sku IS NOT NULL")
+        old_sizes = dict(cur.fetchall())
+        cur.executemany("""
+            INSERT INTO products(sku, name, price, has_sizes, sizes, created_at) VALUES (?,?,?,?,?,?)
+            ON CONFLICT(sku) WHERE sku IS NOT NULL DO UPDATE SET
+              name=excluded.name,
+              price=excluded.price,
+              has_sizes=excluded.has_sizes,
+              sizes=excluded.sizes
+        """, [(it["sku"], it["name"], it["price"], it["has_sizes"], it["sizes"], now) for it in items])
+
+        cur.execute("SELECT sku, id FROM products WHERE sku IS NOT NULL")
+        ids = dict(cur.fetchall())
+        # qoldiq berilganlar qayta yoziladi; o'lchami o'zgarib qoldiq berilmaganlar — kuzatuv o'chadi
+        reset = [
+            ids[it["sku"]] for it in items
+            if "stock" in it or (it["sku"] in old_sizes and (old_sizes[it["sku"]] or None) != it["sizes"])
+        ]
+        cur.executemany("DELETE FROM stock WHERE product_id=?", [(pid,) for pid in reset])
+        cur.executemany(
+            "INSERT INTO stock(product_id, size, qty) VALUES (?,?,?)",
+            [(ids[it["sku"]], size, qty) for it in items if it.get("stock") for size, qty in it["stock"].items()]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    inserted = sum(1 for it in items if it["sku"] not in old_sizes)
+    catalog_invalidate()
+    stock_counter.load()
+    return inserted, len(items) - inserted
+
+async def admin_document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid) or context.user_data.get("state") != A_IMPORT_FILE:
+        return
+
+    doc = update.message.document
+    fname = doc.file_name or ""
+    if not fname.lower().endswith((".csv", ".xlsx")):
+        await update.message.reply_text("❌ Faqat .csv yoki .xlsx fayl yuboring.", reply_markup=back_to_admin_inline())
+        return
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text("❌ Fayl juda katta (10 MB gacha).", reply_markup=back_to_admin_inline())
+        return
+
+    data = await download_file_bytes(context.bot, doc.file_id)
+    if data is None:
+        await update.message.reply_text("⚠️ Faylni yuklab bo‘lmadi. Qayta yuboring.", reply_markup=back_to_admin_inline())
+        return
+
+    try:
+        rows = await asyncio.to_thread(read_table, fname, data)
+        items, errors = await asyncio.to_thread(parse_import, rows)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}", reply_markup=back_to_admin_inline())
+        return
+    except Exception:
+        log.exception("Import faylini o‘qishda xatolik")
+        await update.message.reply_text("❌ Faylni o‘qib bo‘lmadi.", reply_markup=back_to_admin_inline())
+        return
+
+    new, changed, same = import_diff(items)
+    lines = [
+        f"🧾 Import (sinov): {fname}",
+        f"🆕 Yangi: {len(new)}",
+        f"✏️ O‘zgaradi: {len(changed)}",
+        f"➖ O‘zgarishsiz: {same}",
+        f"❌ Xato: {len(errors)}",
+    ]
+    preview = (changed + new)[:IMPORT_PREVIEW_LINES]
+    if preview:
+        lines += [""] + preview
+        rest = len(changed) + len(new) - len(preview)
+        if rest > 0:
+            lines.append(f"… yana {rest} ta")
+    if errors:
+        lines += [""] + errors[:IMPORT_PREVIEW_LINES]
+
+    if not new and not changed:
+        clear_state(context)
+        lines.append("\nQo‘llash uchun o‘zgarish yo‘q.")
+        await update.message.reply_text("\n".join(lines)[:4000], reply_markup=back_to_admin_inline())
+        return
+
+    token = os.urandom(4).hex()
+    store.set("import", token, {"uid": uid, "items": items}, ttl=IMPORT_TTL)
+    clear_state(context)
+    markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Qo‘llash", callback_data=f"A_IMPORT_DO|{token}")],
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data=f"A_IMPORT_NO|{token}")],
+    ])
+    await update.message.reply_text("\n".join(lines)[:4000], reply_markup=markup)
+
+async def admin_import_cancel(q, context: ContextTypes.DEFAULT_TYPE, token: str):
+    # preview (butun qatorlar ro'yxati) store da muddati tugashini kutmaydi
+    pending = store.get("import", token)
+    if pending and pending.get("uid") == q.from_user.id:
+        store.delete("import", token)
+    clear_state(context)
+    await q.message.reply_text("👑 Admin panel:", reply_markup=admin_panel_inline())
+
+async def admin_import_apply(q, context: ContextTypes.DEFAULT_TYPE, token: str):
+    pending = store.get("import", token)
+    if not pending or pending.get("uid") != q.from_user.id:
+        await q.message.reply_text("⚠️ Import muddati o‘tgan. Faylni qayta yuboring.", reply_markup=back_to_admin_inline())
+        return
+    store.delete("import", token)
+
+    started = time_mono()
+    try:
+        inserted, updated = apply_import(pending["items"])
+    except Exception:
+        log.exception("Importni qo‘llashda xatolik")
+        await q.message.reply_text("❌ Import bajarilmadi, o‘zgarishlar bekor qilindi.", reply_markup=back_to_admin_inline())
+        return
+    took = time_mono() - started
+    log.info("Import: %s yangi, %s yangilandi (%.2fs)", inserted, updated, took)
+    await q.message.reply_text(
+        f"✅ Import bajarildi: 🆕 {inserted}, ✏️ {updated} ({took:.1f} s)",
+        reply_markup=back_to_admin_inline()
+    )
+
+# ----------------- Backups (online, gzip snapshots) -----------------
+BACKUP_EVERY_H = float(os.getenv("BACKUP_EVERY_H", "6"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14"))
+BACKUP_PAGES = 256      # bir qadamda nusxalanadigan sahifalar
+BACKUP_STEP_SLEEP = 0.02  # qadamlar orasida yozuvchilarga navbat
+BACKUP_NAME_RE = re.compile(r"^shop-\d{8}-\d{6}\.db\.gz$")
+
+def list_backups() -> list:
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted((f for f in os.listdir(BACKUP_DIR) if BACKUP_NAME_RE.match(f)), reverse=True)
+
+def archive_companion(name: str) -> str:
+    # shop-<vaqt>.db.gz bilan birga olingan arxiv nusxasi
+    return "archive-" + name[len("shop-"):]
+
+def snapshot_db(src_path: str, gz_path: str):
+    # alohida thread va ulanishlarda: SQLite online backup API, kichik qadamlar bilan
+    raw_path = gz_path[:-3] + ".tmp"
+    src = sqlite3.connect(src_path, timeout=15)
+    dst = sqlite3.connect(raw_path)
+    try:
+        src.backup(dst, pages=BACKUP_PAGES, sleep=BACKUP_STEP_SLEEP)
+    finally:
+        dst.close()
+        src.close()
+
+    try:
+        with open(raw_path, "rb") as fin, gzip.open(gz_path + ".tmp", "wb", compresslevel=6) as fout:
+            shutil.copyfileobj(fin, fout, 1024 * 1024)
+        os.replace(gz_path + ".tmp", gz_path)
+    finally:
+        os.remove(raw_path)
+
+def make_backup() -> str:
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    name = f"shop-{datetime.utcnow():%Y%m%d-%H%M%S}.db.gz"
+    # tartib muhim: avval hot, keyin arxiv. Orada ko'chirilgan buyurtma ikkala nusxada
+    # bo'ladi (o'qishlar hot dagisini oladi), hech birida yo'qolib qolmaydi.
+    snapshot_db(DB_PATH, os.path.join(BACKUP_DIR, name))
+    if os.path.exists(ARCHIVE_PATH):
+        snapshot_db(ARCHIVE_PATH, os.path.join(BACKUP_DIR, archive_companion(name)))
+
+    for old in list_backups()[BACKUP_KEEP:]:
+        for f in (old, archive_companion(old)):
+            path = os.path.join(BACKUP_DIR, f)
+            if os.path.exists(path):
+                os.remove(path)
+    return name
+
+def restore_backup(name: str) -> dict:
+    # tekshirish uchun yangi faylga ochiladi; ishlayotgan shop.db ga tegilmaydi
+    if not BACKUP_NAME_RE.match(name):
+        raise ValueError("Noto‘g‘ri nom")
+    # oldingi tekshiruv fayllari joy egallamasin
+    for f in os.listdir(BACKUP_DIR):
+        if f.startswith("restore-"):
+            os.remove(os.path.join(BACKUP_DIR, f))
+
+    def unpack(gz_name: str) -> str:
+        out = os.path.join(BACKUP_DIR, "restore-" + gz_name[:-3])
+        with gzip.open(os.path.join(BACKUP_DIR, gz_name), "rb") as fin, open(out, "wb") as fout:
+            shutil.copyfileobj(fin, fout, 1024 * 1024)
+        return out
+
+    out_path = unpack(name)
+    c = sqlite3.connect(out_path)
+    try:
+        checks = {"shop": c.execute("PRAGMA integrity_check").fetchone()[0]}
+        counts = {
+            t: c.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+            for t in ("users", "products", "orders", "cart")
+        }
+    finally:
+        c.close()
+    size = os.path.getsize(out_path)
+
+    arch_name = archive_companion(name)
+    if os.path.exists(os.path.join(BACKUP_DIR, arch_name)):
+        arch_path = unpack(arch_name)
+        c = sqlite3.connect(arch_path)
+        try:
+            checks["archive"] = c.execute("PRAGMA integrity_check").fetchone()[0]
+            counts["orders (arxiv)"] = c.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        finally:
+            c.close()
+        size += os.path.getsize(arch_path)
+    return {"path": out_path, "checks": checks, "counts": counts, "size": size}
+
+@job_lease(ttl=1800)
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        name = await asyncio.to_thread(make_backup)
+        log.info("Backup yaratildi: %s", name)
+    except Exception:
+        log.exception("Backupda xatolik")
+
+def backup_inline(names: list) -> InlineKeyboardMarkup:
+    kb = [[InlineKeyboardButton("💾 Hozir backup", callback_data="A_BK_NOW")]]
+    for n in names[:5]:
+        kb.append([InlineKeyboardButton(f"♻️ Tekshirish: {n[5:20]}", callback_data=f"A_BK_RS|{n}")])
+    kb.append([InlineKeyboardButton("⬅️ Admin panel", callback_data="A_HOME")])
+    return InlineKeyboardMarkup(kb)
+
+async def admin_backups(q, context: ContextTypes.DEFAULT_TYPE):
+    names = list_backups()
+    lines = [f"💾 Backuplar ({BACKUP_DIR}):"]
+    if not names:
+        lines.append("Hali backup yo‘q.")
+    for n in names[:10]:
+        size = os.path.getsize(os.path.join(BACKUP_DIR, n))
+        arch_path = os.path.join(BACKUP_DIR, archive_companion(n))
+        extra = f" + arxiv {os.path.getsize(arch_path) // 1024} KB" if os.path.exists(arch_path) else ""
+        lines.append(f"• {n} — {size // 1024} KB{extra}")
+    await q.message.reply_text("\n".join(lines), reply_markup=backup_inline(names))
+
+async def admin_backup_now(q, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        name = await asyncio.to_thread(make_backup)
+    except Exception:
+        log.exception("Backupda xatolik")
+        await q.message.reply_text("❌ Backup bajarilmadi.", reply_markup=back_to_admin_inline())
+        return
+    await q.message.reply_text(f"✅ Backup: {name}", reply_markup=backup_inline(list_backups()))
+
+async def admin_backup_restore(q, context: ContextTypes.DEFAULT_TYPE, name: str):
+    if name not in list_backups():
+        await q.message.reply_text("Backup topilmadi.", reply_markup=back_to_admin_inline())
+        return
+    try:
+        info = await asyncio.to_thread(restore_backup, name)
+    except Exception:
+        log.exception("Restore tekshiruvida xatolik")
+        await q.message.reply_text("❌ Backupni ochib bo‘lmadi.", reply_markup=back_to_admin_inline())
+        return
+    counts = ", ".join(f"{t}: {n}" for t, n in info["counts"].items())
+    await q.message.reply_text(
+        f"♻️ {name} → {info['path']}\n"
+        f"🔎 integrity_check: {', '.join(f'{k}: {v}' for k, v in info['checks'].items())}\n"
+        f"📦 {info['size'] // 1024} KB\n"
+        f"🧾 {counts}",
+        reply_markup=back_to_admin_inline()
+    )
+
+# ----------------- Order archive (retention) -----------------
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))  # 0 — o'chirilgan
+ARCHIVE_BATCH = 500
+VACUUM_PAGES = 2000  # bir ishga tushishda bo'shatiladigan sahifalar
+# eski (auto_vacuum=NONE) bazani bir marta o'tkazish: to'liq VACUUM, faqat ishga tushishda
+VACUUM_CONVERT = os.getenv("VACUUM_CONVERT", "0").strip() == "1"
+
+def archive_batch(cutoff: str, limit: int = ARCHIVE_BATCH) -> int:
+    # rollup lar tegilmaydi: ular allaqachon bu buyurtmalarni hisoblagan.
+    # Ikki faylga birga commit atomar emas: avval arxivga yozib commit, keyin o'chirish.
+    # Orada uzilsa buyurtma ikkala faylda qoladi (o'qishlarda hot ustun), keyingi
+    # urinish OR IGNORE bilan o'chirishni tugatadi.
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("SELECT id FROM main.orders WHERE created_at < ? ORDER BY created_at LIMIT ?", (cutoff, limit))
+        ids = [r[0] for r in cur.fetchall()]
+        if ids:
+            marks = ",".join("?" * len(ids))
+            cur.execute(f"""
+                INSERT OR IGNORE INTO arch.orders(id, user_id, items_json, total, created_at, token, archived_at)
+                SELECT id, user_id, items_json, total, created_at, token, ?
+                FROM main.orders WHERE id IN ({marks})
+            """, (datetime.utcnow().isoformat(), *ids))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if not ids:
+        return 0
+
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        # faqat arxivda borligi tasdiqlanganlari o'chiriladi
+        cur.execute(f"""
+            DELETE FROM main.orders
+            WHERE id IN ({marks}) AND id IN (SELECT id FROM arch.orders WHERE id IN ({marks}))
+        """, (*ids, *ids))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(ids)
+
+def convert_auto_vacuum():
+    # to'liq VACUUM butun faylni yozish lockida qayta yozadi — update qabul qilishdan oldin
+    resolve_paths()
+    c = sqlite3.connect(DB_PATH, timeout=15)
+    try:
+        if c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        t0 = time_mono()
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        c.execute("VACUUM")
+        log.info("DB auto_vacuum=INCREMENTAL ga o'tkazildi (%.1f s)", time_mono() - t0)
+    finally:
+        c.close()
+
+def vacuum_hot_db() -> int:
+    # alohida ulanishda (thread): faqat qismlab bo'shatish, to'liq VACUUM hech qachon
+    c = sqlite3.connect(DB_PATH, timeout=15)
+    try:
+        if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            log.info("Eski DB: incremental_vacuum o'chiq (bir marta VACUUM_CONVERT=1 bilan ishga tushiring)")
+            return 0
+        free = c.execute("PRAGMA freelist_count").fetchone()[0]
+        c.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+        return min(free, VACUUM_PAGES)
+    finally:
+        c.close()
+
+@job_lease(ttl=1800)
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return
+    cutoff = (datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+    moved = 0
+    try:
+        while not lifecycle.stopping.is_set():
+            n = archive_batch(cutoff)
+            moved += n
+            if n < ARCHIVE_BATCH:
+                break
+            # partiyalar orasida handlerlarga navbat
+            await asyncio.sleep(0.05)
+        freed = await asyncio.to_thread(vacuum_hot_db)
+        log.info("Arxiv: %s ta buyurtma ko‘chirildi, %s sahifa bo‘shatildi", moved, freed)
+    except Exception:
+        log.exception("Arxivlashda xatolik")
+
+def export_orders_csv(path: str) -> int:
+    # faqat o'qish uchun alohida ulanish (arxiv ham ro biriktiriladi), qatorlar oqim bilan yoziladi
+    n = 0
+    c = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=15)
+    try:
+        queries = [("SELECT id, user_id, created_at, total, items_json FROM main.orders ORDER BY id", 0)]
+        if os.path.exists(ARCHIVE_PATH):
+            c.execute("ATTACH DATABASE ? AS arch", (f"file:{ARCHIVE_PATH}?mode=ro",))
+            # ko'chirish orasida ikkala faylda bo'lsa — hot dagisi olinadi
+            queries.insert(0, ("""
+                SELECT id, user_id, created_at, total, items_json FROM arch.orders a
+                WHERE NOT EXISTS (SELECT 1 FROM main.orders m WHERE m.id=a.id)
+                ORDER BY id
+            """, 1))
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["id", "user_id", "created_at", "total", "items", "archived"])
+            for sql, archived in queries:
+                for oid, uid, created_at, total, items_json in c.execute(sql):
+                    try:
+                        items = "; ".join(
+                            f"{it.get('name', '?')} ({it.get('size') or '-'}) x{it.get('qty', 1)}"
+                            for it in json.loads(items_json)
+                        )
+                    except Exception:
+                        items = items_json
+                    w.writerow([oid, uid, created_at, total, items, archived])
+                    n += 1
+    finally:
+        c.close()
+    return n
+
+async def admin_export_orders(q, context: ContextTypes.DEFAULT_TYPE):
+    path = os.path.join(WRITABLE_DIR, f"orders-{os.urandom(4).hex()}.csv")
+    try:
+        n = await asyncio.to_thread(export_orders_csv, path)
+        with open(path, "rb") as f:
+            await q.message.reply_document(
+                document=f,
+                filename=f"orders-{datetime.utcnow():%Y%m%d}.csv",
+                caption=f"🗄 Buyurtmalar: {n} ta (arxiv bilan)",
+            )
+    except Exception:
+        log.exception("Eksportda xatolik")
+        await q.message.reply_text("❌ Eksport bajarilmadi.", reply_markup=back_to_admin_inline())
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
 # ----------------- Admin stats (text chart) -----------------
 def make_bar(value: int, max_value: int, width: int = 18) -> str:
+    if value <= 0:
+        return "▱" * width
     if max_value <= 0:
         return "▰"
     filled = int((value / max_value) * width)
     filled = max(1, min(width, filled))
     return "▰" * filled + "▱" * (width - filled)
 
+def stats_inline() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("📅 Kunlik", callback_data="A_STATS_P|day"),
+            InlineKeyboardButton("🗓 Haftalik", callback_data="A_STATS_P|week"),
+            InlineKeyboardButton("📆 Oylik", callback_data="A_STATS_P|month"),
+        ],
+        [InlineKeyboardButton("🖼 Grafik (rasm)", callback_data="A_STATS_IMG")],
+        [InlineKeyboardButton("⬅️ Admin panel", callback_data="A_HOME")],
+    ])
+
 async def send_stats(q, context: ContextTypes.DEFAULT_TYPE):
     cur.execute("SELECT COUNT(*) FROM users")
     users_count = int(cur.fetchone()[0])
 
-    cur.execute("SELECT COUNT(*), COALESCE(SUM(total),0) FROM orders")
+    # jami ko'rsatkichlar rollupdan (orders skan qilinmaydi)
+    cur.execute("SELECT COALESCE(SUM(orders_count),0), COALESCE(SUM(revenue),0) FROM daily_sales")
     orders_count, revenue = cur.fetchone()
     orders_count = int(orders_count)
     revenue = int(revenue or 0)
 
-    cur.execute("SELECT items_json FROM orders ORDER BY id DESC LIMIT 2000")
-    rows = cur.fetchall()
-
-    counts = {}
-    for (items_json,) in rows:
-        try:
-            items = json.loads(items_json)
-            for it in items:
-                nm = it.get("name", "Unknown")
-                qty = int(it.get("qty", 1))
-                counts[nm] = counts.get(nm, 0) + qty
-        except Exception:
-            continue
-
-    top = sorted(counts.items(), key=lambda x: x[1], reverse=True)[:8]
+    cur.execute("""
+        SELECT name, SUM(qty) AS q FROM daily_product_sales
+        GROUP BY name ORDER BY q DESC LIMIT 8
+    """)
+    top = [(name, int(qty)) for name, qty in cur.fetchall()]
 
     text = (
         "📊 Statistika\n\n"
@@ -591,7 +2222,7 @@ async def send_stats(q, context: ContextTypes.DEFAULT_TYPE):
 
     if not top:
         text += "Grafik uchun hali buyurtmalar yetarli emas."
-        await q.message.reply_text(text, reply_markup=back_to_admin_inline())
+        await q.message.reply_text(text, reply_markup=stats_inline())
         return
 
     max_qty = max(v for _, v in top)
@@ -599,7 +2230,221 @@ async def send_stats(q, context: ContextTypes.DEFAULT_TYPE):
     for name, qty in top:
         text += f"{make_bar(qty, max_qty)}  {qty}  — {name}\n"
 
-    await q.message.reply_text(text, reply_markup=back_to_admin_inline())
+    await q.message.reply_text(text, reply_markup=stats_inline())
+
+async def send_sales_period(q, context: ContextTypes.DEFAULT_TYPE, period: str):
+    if period not in STATS_PERIODS:
+        period = "day"
+    title, count = STATS_PERIODS[period]
+    buckets = sales_buckets(period, count)
+
+    # buckets[0] faqat taqqoslash uchun, ko'rsatilmaydi
+    shown = buckets[1:]
+    max_rev = max(r for _, _, r in shown)
+    max_cnt = max(c for _, c, _ in shown)
+
+    lines = [f"📊 {title} savdo\n", "💰 Tushum:"]
+    for i, (start, cnt, rev) in enumerate(shown, start=1):
+        prev_rev = buckets[i - 1][2]
+        lines.append(
+            f"{bucket_label(start, period)} {make_bar(rev, max_rev, width=12)} "
+            f"{money(rev)} {pct_change(rev, prev_rev)}"
+        )
+
+    lines.append("\n🧾 Buyurtmalar soni:")
+    for i, (start, cnt, rev) in enumerate(shown, start=1):
+        prev_cnt = buckets[i - 1][1]
+        lines.append(
+            f"{bucket_label(start, period)} {make_bar(cnt, max_cnt, width=12)} "
+            f"{cnt} {pct_change(cnt, prev_cnt)}"
+        )
+
+    _, cur_cnt, cur_rev = buckets[-1]
+    _, prev_cnt, prev_rev = buckets[-2]
+    lines.append(
+        f"\n📌 Joriy davr: {money(cur_rev)} so'm / {cur_cnt} ta "
+        f"(oldingi: {money(prev_rev)} so'm / {prev_cnt} ta, {pct_change(cur_rev, prev_rev)})"
+    )
+
+    await q.message.reply_text("\n".join(lines), reply_markup=stats_inline())
+
+# ----------------- Admin stats (PNG chart) -----------------
+CHART_W, CHART_H = 800, 560
+CHART_DAYS = 30
+CHART_TOP = 15
+
+C_BG = (255, 255, 255)
+C_AXIS = (90, 90, 90)
+C_GRID = (230, 230, 230)
+C_REV = (46, 125, 196)
+C_TODAY = (240, 140, 40)
+C_TOP = (67, 160, 71)
+C_TEXT = (40, 40, 40)
+
+# 3x5 bitmap shrift (faqat raqamlar) — tashqi kutubxonasiz
+DIGITS_3X5 = {
+    "0": ("111", "101", "101", "101", "111"),
+    "1": ("010", "110", "010", "010", "111"),
+    "2": ("111", "001", "111", "100", "111"),
+    "3": ("111", "001", "111", "001", "111"),
+    "4": ("101", "101", "111", "001", "001"),
+    "5": ("111", "100", "111", "001", "111"),
+    "6": ("111", "100", "111", "101", "111"),
+    "7": ("111", "001", "010", "010", "010"),
+    "8": ("111", "101", "111", "101", "111"),
+    "9": ("111", "101", "111", "001", "111"),
+}
+
+class Canvas:
+    def __init__(self, width: int, height: int, bg=C_BG):
+        self.w = width
+        self.h = height
+        self.px = bytearray(bytes(bg) * (width * height))
+
+    def rect(self, x0: int, y0: int, x1: int, y1: int, color):
+        x0, x1 = max(0, min(x0, x1)), min(self.w, max(x0, x1))
+        y0, y1 = max(0, min(y0, y1)), min(self.h, max(y0, y1))
+        if x0 >= x1 or y0 >= y1:
+            return
+        row = bytes(color) * (x1 - x0)
+        for y in range(y0, y1):
+            i = (y * self.w + x0) * 3
+            self.px[i:i + len(row)] = row
+
+    def number(self, x: int, y: int, value: int, color=C_TEXT, scale: int = 2):
+        for ch in str(value):
+            glyph = DIGITS_3X5.get(ch)
+            if glyph:
+                for gy, line in enumerate(glyph):
+                    for gx, bit in enumerate(line):
+                        if bit == "1":
+                            self.rect(x + gx * scale, y + gy * scale,
+                                      x + (gx + 1) * scale, y + (gy + 1) * scale, color)
+            x += 4 * scale
+
+    def png(self) -> bytes:
+        stride = self.w * 3
+        raw = b"".join(
+            b"\x00" + bytes(self.px[y * stride:(y + 1) * stride]) for y in range(self.h)
+        )
+
+        def chunk(tag: bytes, data: bytes) -> bytes:
+            return (struct.pack(">I", len(data)) + tag + data +
+                    struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+        return (
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", self.w, self.h, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 6))
+            + chunk(b"IEND", b"")
+        )
+
+def render_stats_png(daily: list, top: list) -> bytes:
+    # daily: [(date, revenue), ...] eskidan yangiga; top: [(name, qty), ...]
+    c = Canvas(CHART_W, CHART_H)
+    pad = 40
+
+    # 1) tushum vaqt bo'yicha (ustunlar)
+    top_y0, top_y1 = 20, 260
+    c.rect(pad, top_y1, CHART_W - pad, top_y1 + 2, C_AXIS)
+    for k in range(1, 5):
+        gy = top_y1 - (top_y1 - top_y0) * k // 4
+        c.rect(pad, gy, CHART_W - pad, gy + 1, C_GRID)
+    max_rev = max((r for _, r in daily), default=0)
+    slot = (CHART_W - 2 * pad) // max(1, len(daily))
+    for i, (day, rev) in enumerate(daily):
+        x0 = pad + i * slot + 2
+        if rev > 0 and max_rev > 0:
+            h = max(2, (top_y1 - top_y0) * rev // max_rev)
+            color = C_TODAY if i == len(daily) - 1 else C_REV
+            c.rect(x0, top_y1 - h, x0 + slot - 4, top_y1, color)
+        if day.day == 1 or (i % 5 == 0 and day.day > 2) or i == len(daily) - 1:
+            c.number(x0, top_y1 + 8, day.day, C_AXIS)
+
+    # 2) top mahsulotlar (gorizontal ustunlar, raqami caption bilan mos)
+    bot_y0 = 310
+    row_h = (CHART_H - bot_y0 - 10) // max(1, CHART_TOP)
+    max_qty = max((v for _, v in top), default=0)
+    bar_x0 = pad + 30
+    for i, (_, qty) in enumerate(top):
+        y = bot_y0 + i * row_h
+        c.number(pad, y + 2, i + 1, C_TEXT)
+        if max_qty > 0:
+            w = max(2, (CHART_W - pad - bar_x0 - 60) * qty // max_qty)
+            c.rect(bar_x0, y, bar_x0 + w, y + row_h - 4, C_TOP)
+            c.number(bar_x0 + w + 6, y + 2, qty, C_TEXT)
+
+    return c.png()
+
+def stats_chart_data():
+    today = datetime.now(timezone.utc).date()
+    start = today - timedelta(days=CHART_DAYS - 1)
+    days = sales_days(start, today)
+    daily = []
+    for i in range(CHART_DAYS):
+        d = start + timedelta(days=i)
+        daily.append((d, days.get(d.isoformat(), (0, 0))[1]))
+
+    cur.execute("""
+        SELECT name, SUM(qty) AS q FROM daily_product_sales
+        GROUP BY name ORDER BY q DESC LIMIT ?
+    """, (CHART_TOP,))
+    top = [(name, int(qty)) for name, qty in cur.fetchall()]
+    return daily, top
+
+def chart_cache_get(key: str, version: str):
+    cur.execute("SELECT file_id FROM chart_cache WHERE key=? AND version=?", (key, version))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def chart_cache_put(key: str, version: str, file_id: str):
+    cur.execute(
+        "INSERT OR REPLACE INTO chart_cache(key, version, file_id, created_at) VALUES (?,?,?,?)",
+        (key, version, file_id, datetime.utcnow().isoformat())
+    )
+    conn.commit()
+
+async def send_stats_chart(q, context: ContextTypes.DEFAULT_TYPE):
+    # kun almashsa ham 30 kunlik oyna siljiydi — versiyaga sana ham kiradi
+    today = datetime.now(timezone.utc).date()
+    version = f"{stats_version()}:{today.isoformat()}"
+    key = "overview"
+
+    daily, top = stats_chart_data()
+    caption_lines = [f"📊 Tushum: oxirgi {CHART_DAYS} kun (🟧 bugun)", "📈 Top mahsulotlar:"]
+    caption_lines += [f"{i}. {name} — {qty}" for i, (name, qty) in enumerate(top, start=1)]
+    caption = "\n".join(caption_lines)[:1024]
+
+    file_id = chart_cache_get(key, version)
+    if file_id:
+        try:
+            await q.message.reply_photo(photo=file_id, caption=caption, reply_markup=stats_inline())
+            return
+        except Exception:
+            log.warning("Grafik file_id eskirgan, qayta chiziladi")
+
+    png = await asyncio.to_thread(render_stats_png, daily, top)
+    msg = await q.message.reply_photo(photo=png, caption=caption, reply_markup=stats_inline())
+    if msg and msg.photo:
+        chart_cache_put(key, version, msg.photo[-1].file_id)
+
+@job_lease(ttl=3600)
+async def rollup_rebuild_job(context: ContextTypes.DEFAULT_TYPE):
+    # tungi: faqat oxirgi ROLLUP_RECHECK_DAYS kun (arxiv har kecha qayta o'qilmaydi)
+    since = (datetime.now(timezone.utc).date() - timedelta(days=ROLLUP_RECHECK_DAYS)).isoformat()
+    try:
+        await asyncio.to_thread(rebuild_rollups, since)
+        log.info("daily_sales rollup %s dan qayta hisoblandi", since)
+    except Exception:
+        log.exception("daily_sales rollup qayta hisoblashda xatolik")
+
+@job_lease(ttl=3600)
+async def rollup_full_rebuild_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await asyncio.to_thread(rebuild_rollups)
+        log.info("daily_sales rollup to‘liq qayta hisoblandi")
+    except Exception:
+        log.exception("daily_sales rollup qayta hisoblashda xatolik")
 
 # ----------------- Admin flows (text/photo/broadcast/edit) -----------------
 async def admin_text_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
@@ -654,6 +2499,7 @@ async def admin_text_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             return True
         cur.execute("UPDATE products SET name=? WHERE id=?", (text, pid))
         conn.commit()
+        catalog_invalidate()
         clear_state(context)
         await update.message.reply_text("✅ Nomi yangilandi.", reply_markup=back_to_admin_inline())
         return True
@@ -669,6 +2515,7 @@ async def admin_text_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             return True
         cur.execute("UPDATE products SET price=? WHERE id=?", (int(text), pid))
         conn.commit()
+        catalog_invalidate()
         clear_state(context)
         await update.message.reply_text("✅ Narx yangilandi.", reply_markup=back_to_admin_inline())
         return True
@@ -684,15 +2531,45 @@ async def admin_text_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         else:
             cur.execute("UPDATE products SET has_sizes=1, sizes=? WHERE id=?", (text, pid))
         conn.commit()
+        catalog_invalidate()
         clear_state(context)
+        # o'lchamlar o'zgardi — eski qoldiq qatorlari endi mos emas
+        if stock_counter.for_product(int(pid)):
+            set_stock(int(pid), None)
+            await update.message.reply_text(
+                "✅ O‘lchamlar yangilandi.\n⚠️ Qoldiq kuzatuvi o‘chirildi — 📦 Qoldiq orqali qayta kiriting.",
+                reply_markup=back_to_admin_inline()
+            )
+            return True
         await update.message.reply_text("✅ O‘lchamlar yangilandi.", reply_markup=back_to_admin_inline())
         return True
 
+    if state == A_EDIT_STOCK:
+        pid = context.user_data.get("edit_pid")
+        p = product_by_id(int(pid)) if pid else None
+        if not p:
+            await update.message.reply_text("⚠️ Avval mahsulot tanlang.", reply_markup=back_to_admin_inline())
+            clear_state(context)
+            return True
+        try:
+            mapping = parse_stock(text, bool(p[3] and p[4]), p[4])
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}", reply_markup=back_to_admin_inline())
+            return True
+        set_stock(int(pid), mapping)
+        clear_state(context)
+        await update.message.reply_text(
+            "✅ Qoldiq yangilandi.\n" + (stock_text(int(pid)) or "📦 Cheklanmagan"),
+            reply_markup=back_to_admin_inline()
+        )
+        return True
+
     # BROADCAST (text)
     if state == A_BC_TEXT:
-        await do_broadcast_text(update, context, text)
+        segment = context.user_data.get("bc_segment")
         clear_state(context)
-        await update.message.reply_text("✅ Broadcast yuborildi.", reply_markup=back_to_admin_inline())
+        if await do_broadcast_text(update, context, text, segment):
+            await update.message.reply_text("✅ Broadcast yuborildi.", reply_markup=back_to_admin_inline())
         return True
 
     return False
@@ -725,6 +2602,9 @@ async def admin_photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
             (name, int(price), has_sizes, sizes if has_sizes else None, file_id, now)
         )
         conn.commit()
+        new_pid = cur.lastrowid
+        catalog_invalidate()
+        await media_register(context.bot, new_pid, update.message.photo)
         clear_state(context)
         await update.message.reply_text("✅ Mahsulot qo‘shildi!", reply_markup=back_to_admin_inline())
         return
@@ -737,10 +2617,7 @@ async def admin_photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
             clear_state(context)
             return
 
-        photo = update.message.photo[-1]
-        file_id = photo.file_id
-        cur.execute("UPDATE products SET photo_file_id=? WHERE id=?", (file_id, pid))
-        conn.commit()
+        await media_register(context.bot, int(pid), update.message.photo)
         clear_state(context)
         await update.message.reply_text("✅ Rasm yangilandi.", reply_markup=back_to_admin_inline())
         return
@@ -748,34 +2625,248 @@ async def admin_photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     # BROADCAST PHOTO
     if state == A_BC_TEXT:
         cap = update.message.caption or ""
-        await do_broadcast_photo(update, context, update.message.photo[-1].file_id, cap)
+        segment = context.user_data.get("bc_segment")
         clear_state(context)
-        await update.message.reply_text("✅ Broadcast (rasm) yuborildi.", reply_markup=back_to_admin_inline())
+        if await do_broadcast_photo(update, context, update.message.photo[-1].file_id, cap, segment):
+            await update.message.reply_text("✅ Broadcast (rasm) yuborildi.", reply_markup=back_to_admin_inline())
         return
 
-async def do_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
-    cur.execute("SELECT user_id FROM users")
-    users = cur.fetchall()
-    ok, fail = 0, 0
-    for (uid,) in users:
-        try:
-            await context.bot.send_message(uid, text)
-            ok += 1
-        except Exception:
-            fail += 1
-    await update.message.reply_text(f"📢 Broadcast natija: ✅{ok} / ❌{fail}", reply_markup=back_to_admin_inline())
-
-async def do_broadcast_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: str, caption: str):
-    cur.execute("SELECT user_id FROM users")
-    users = cur.fetchall()
-    ok, fail = 0, 0
-    for (uid,) in users:
+# ----------------- Broadcast segments -----------------
+# har segment: user_id bo'yicha tartiblangan, indeksga tayangan so'rov.
+# Ro'yxat xotirada yig'ilmaydi — _run_broadcast keyset bilan partiyalab o'qiydi.
+BC_SEGMENT_DAYS = (7, 30)
+BC_INACTIVE_DAYS = 30
+BC_PRODUCTS_MAX = 30
+
+def segment_query(segment: dict | None):
+    # (so'rov, parametrlar, kalit ustun); keyset sharti va ORDER BY segment_batch da qo'shiladi
+    t = (segment or {}).get("type", "all")
+    if t == "product":
+        # order_items PK (product_id, user_id, ...) — tartib va DISTINCT indeksdan
+        return ("SELECT DISTINCT oi.user_id FROM order_items oi JOIN users u ON u.user_id=oi.user_id "
+                "WHERE oi.product_id=?", [int(segment["product_id"])], "oi.user_id")
+    if t == "cart":
+        return ("SELECT DISTINCT c.user_id FROM cart c JOIN users u ON u.user_id=c.user_id "
+                "WHERE 1", [], "c.user_id")
+    if t == "recent":
+        return ("SELECT u.user_id FROM users u WHERE u.created_at >= ?", [segment["since"]], "u.user_id")
+    if t == "inactive":
+        # ARCHIVE_AFTER_DAYS oynadan qisqa bo'lsa yangi buyurtmalar arxivda ham bo'ladi;
+        # arch dagi tekshiruv idx_arch_orders_created bo'yicha (odatda bo'sh oraliq)
+        return ("SELECT u.user_id FROM users u WHERE NOT EXISTS "
+                "(SELECT 1 FROM main.orders o WHERE o.user_id=u.user_id AND o.created_at >= ?) "
+                "AND NOT EXISTS "
+                "(SELECT 1 FROM arch.orders a WHERE a.created_at >= ? AND a.user_id=u.user_id)",
+                [segment["since"], segment["since"]], "u.user_id")
+    return "SELECT u.user_id FROM users u WHERE 1", [], "u.user_id"
+
+def segment_batch(segment: dict | None, after: int, limit: int) -> list:
+    sql, params, key = segment_query(segment)
+    cur.execute(f"{sql} AND {key} > ? ORDER BY {key} LIMIT ?", (*params, after, limit))
+    return [r[0] for r in cur.fetchall()]
+
+def segment_count(segment: dict | None) -> int:
+    sql, params, _ = segment_query(segment)
+    cur.execute(f"SELECT COUNT(*) FROM ({sql})", params)
+    return int(cur.fetchone()[0])
+
+def segment_make(kind: str, arg: str | None = None) -> dict:
+    # "since" yaratilganda qotiriladi: davom ettirilgan broadcast ham shu ro'yxat bo'yicha
+    if kind in ("recent", "inactive"):
+        days = int(arg or BC_INACTIVE_DAYS)
+        since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+        return {"type": kind, "days": days, "since": since}
+    if kind == "product":
+        return {"type": "product", "product_id": int(arg)}
+    if kind == "cart":
+        return {"type": "cart"}
+    return {"type": "all"}
+
+def segment_label(segment: dict | None) -> str:
+    t = (segment or {}).get("type", "all")
+    if t == "product":
+        p = product_by_id(segment["product_id"])
+        return f"buyurtma qilgan: {p[1] if p else '#' + str(segment['product_id'])}"
+    if t == "cart":
+        return "savati bo‘sh emas"
+    if t == "recent":
+        return f"oxirgi {segment['days']} kunda ro‘yxatdan o‘tgan"
+    if t == "inactive":
+        return f"{segment['days']} kun buyurtmasiz"
+    return "hammasi"
+
+def bc_segments_inline() -> InlineKeyboardMarkup:
+    kb = []
+    options = [("all", None, "👥"), ("cart", None, "🛒")]
+    options += [("recent", str(d), "🆕") for d in BC_SEGMENT_DAYS]
+    options.append(("inactive", str(BC_INACTIVE_DAYS), "💤"))
+    for kind, arg, icon in options:
+        seg = segment_make(kind, arg)
+        cb = f"A_BC_SEG|{kind}" + (f"|{arg}" if arg else "")
+        kb.append([InlineKeyboardButton(f"{icon} {segment_label(seg)} ({segment_count(seg)})", callback_data=cb)])
+    kb.append([InlineKeyboardButton("📦 Mahsulot bo‘yicha", callback_data="A_BC_PROD")])
+    kb.append([InlineKeyboardButton("⬅️ Admin panel", callback_data="A_HOME")])
+    return InlineKeyboardMarkup(kb)
+
+def bc_products_inline() -> InlineKeyboardMarkup:
+    # mahsulot bo'yicha qabul qiluvchilar soni bitta guruhlangan so'rovda
+    cur.execute("""
+        SELECT oi.product_id, COUNT(DISTINCT oi.user_id)
+        FROM order_items oi JOIN users u ON u.user_id=oi.user_id
+        GROUP BY oi.product_id
+        ORDER BY 2 DESC
+        LIMIT ?
+    """, (BC_PRODUCTS_MAX,))
+    kb = []
+    for pid, n in cur.fetchall():
+        p = product_by_id(pid)
+        name = p[1] if p else f"#{pid} (o‘chirilgan)"
+        kb.append([InlineKeyboardButton(f"📦 {name} ({n})", callback_data=f"A_BC_SEG|product|{pid}")])
+    kb.append([InlineKeyboardButton("⬅️ Segmentlar", callback_data="A_BC")])
+    return InlineKeyboardMarkup(kb)
+
+async def admin_bc_pick_segment(q, context: ContextTypes.DEFAULT_TYPE, kind: str, arg: str | None):
+    segment = segment_make(kind, arg)
+    n = segment_count(segment)
+    if n == 0:
+        await q.message.reply_text(
+            f"🎯 {segment_label(segment)}: qabul qiluvchi yo‘q.",
+            reply_markup=bc_segments_inline()
+        )
+        return
+    clear_state(context)
+    context.user_data["state"] = A_BC_TEXT
+    context.user_data["bc_segment"] = segment
+    await q.message.reply_text(
+        f"🎯 {segment_label(segment)}: {n} ta qabul qiluvchi.\n\n"
+        "📢 Broadcast uchun matn kiriting (yoki rasm yuboring):",
+        reply_markup=back_to_admin_inline()
+    )
+
+# ----------------- Broadcast jobs (resumable) -----------------
+BC_BATCH = 100
+# worker o'lsa, lock shuncha soniyadan keyin boshqasiga o'tadi
+BC_LOCK_TTL = 120
+
+# shu jarayonda ishlayotgan broadcast id lari
+bc_running = set()
+
+def bc_job_create(kind: str, payload: dict, admin_chat_id: int, segment: dict | None = None) -> int:
+    cur.execute(
+        "INSERT INTO bc_jobs(kind, payload, admin_chat_id, segment, created_at) VALUES (?,?,?,?,?)",
+        (kind, json.dumps(payload, ensure_ascii=False), admin_chat_id,
+         json.dumps(segment) if segment else None, datetime.utcnow().isoformat())
+    )
+    conn.commit()
+    return cur.lastrowid
+
+def bc_job_save(job_id: int, cursor: int, ok: int, fail: int, status: str):
+    cur.execute(
+        "UPDATE bc_jobs SET cursor=?, ok=?, fail=?, status=? WHERE id=?",
+        (cursor, ok, fail, status, job_id)
+    )
+    conn.commit()
+
+async def bc_send_one(bot, kind: str, payload: dict, uid: int):
+    if kind == "photo":
+        await bot.send_photo(uid, photo=payload["file_id"], caption=payload.get("caption", "")[:1024])
+    else:
+        await bot.send_message(uid, payload["text"])
+
+async def run_broadcast(bot, job_id: int) -> str:
+    # bir vaqtda bitta worker yuboradi (bc:<id> lock)
+    lock = f"bc:{job_id}"
+    if job_id in bc_running or not store.acquire_lock(lock, WORKER_OWNER, BC_LOCK_TTL):
+        return "busy"
+    bc_running.add(job_id)
+    try:
+        return await _run_broadcast(bot, job_id, lock)
+    finally:
+        bc_running.discard(job_id)
+        store.release_lock(lock, WORKER_OWNER)
+
+async def _run_broadcast(bot, job_id: int, lock: str) -> str:
+    # segment bo'yicha user_id tartibida; har partiyadan keyin cursor saqlanadi.
+    # shutdown boshlansa 'running' holatda qoladi va post_init da davom ettiriladi.
+    cur.execute("SELECT kind, payload, segment, cursor, ok, fail, status FROM bc_jobs WHERE id=?", (job_id,))
+    kind, payload, segment, cursor, ok, fail, status = cur.fetchone()
+    if status == "done":
+        return "done"
+    payload = json.loads(payload)
+    segment = json.loads(segment) if segment else None
+
+    while True:
+        batch = segment_batch(segment, cursor, BC_BATCH)
+        if not batch:
+            bc_job_save(job_id, cursor, ok, fail, "done")
+            return "done"
+
+        for uid in batch:
+            if lifecycle.stopping.is_set():
+                bc_job_save(job_id, cursor, ok, fail, "running")
+                log.info("Broadcast #%s to'xtatildi (cursor=%s), restartdan keyin davom etadi", job_id, cursor)
+                return "paused"
+            try:
+                await bc_send_one(bot, kind, payload, uid)
+                ok += 1
+            except Exception:
+                fail += 1
+            cursor = uid
+
+        bc_job_save(job_id, cursor, ok, fail, "running")
+        store.acquire_lock(lock, WORKER_OWNER, BC_LOCK_TTL)
+
+def bc_job_result(job_id: int):
+    cur.execute("SELECT ok, fail FROM bc_jobs WHERE id=?", (job_id,))
+    return cur.fetchone()
+
+async def do_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, payload: dict, title: str,
+                       segment: dict | None = None) -> bool:
+    job_id = bc_job_create(kind, payload, update.effective_chat.id, segment)
+    status = await run_broadcast(context.bot, job_id)
+    if status != "done":
+        await update.message.reply_text(
+            "⏸ Bot qayta ishga tushmoqda. Broadcast to‘xtatildi va keyin davom etadi.",
+            reply_markup=back_to_admin_inline()
+        )
+        return False
+    ok, fail = bc_job_result(job_id)
+    await update.message.reply_text(
+        f"📢 {title} [{segment_label(segment)}] natija: ✅{ok} / ❌{fail}",
+        reply_markup=back_to_admin_inline()
+    )
+    return True
+
+async def do_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str,
+                            segment: dict | None = None) -> bool:
+    return await do_broadcast(update, context, "text", {"text": text}, "Broadcast", segment)
+
+async def do_broadcast_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: str, caption: str,
+                             segment: dict | None = None) -> bool:
+    return await do_broadcast(update, context, "photo", {"file_id": file_id, "caption": caption}, "Broadcast (rasm)", segment)
+
+async def resume_broadcasts(app):
+    cur.execute("SELECT id, admin_chat_id FROM bc_jobs WHERE status='running' ORDER BY id")
+    for job_id, admin_chat_id in cur.fetchall():
+        if job_id in bc_running:
+            continue
+        app.create_task(finish_resumed_broadcast(app.bot, job_id, admin_chat_id))
+
+async def bc_resume_job(context: ContextTypes.DEFAULT_TYPE):
+    # boshqa worker o'lib qolgan bo'lsa, lock muddati o'tgach shu yerda olinadi
+    await resume_broadcasts(context.application)
+
+async def finish_resumed_broadcast(bot, job_id: int, admin_chat_id: int):
+    status = await run_broadcast(bot, job_id)
+    if status == "busy":
+        return
+    log.info("Broadcast #%s davom ettirildi: %s", job_id, status)
+    if status == "done":
+        ok, fail = bc_job_result(job_id)
         try:
-            await context.bot.send_photo(uid, photo=file_id, caption=caption[:1024])
-            ok += 1
+            await bot.send_message(admin_chat_id, f"📢 Broadcast #{job_id} (davom ettirildi) natija: ✅{ok} / ❌{fail}")
         except Exception:
-            fail += 1
-    await update.message.reply_text(f"📢 Broadcast (rasm) natija: ✅{ok} / ❌{fail}", reply_markup=back_to_admin_inline())
+            pass
 
 # ----------------- Callbacks -----------------
 async def cb_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -825,6 +2916,7 @@ async def cb_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 [InlineKeyboardButton("💰 Narx", callback_data="A_EF|price")],
                 [InlineKeyboardButton("📐 O‘lchamlar", callback_data="A_EF|sizes")],
                 [InlineKeyboardButton("🖼 Rasm", callback_data="A_EF|photo")],
+                [InlineKeyboardButton("📦 Qoldiq", callback_data="A_EF|stock")],
                 [InlineKeyboardButton("❌ O‘chirish", callback_data=f"A_DEL_DO|{pid}")],
                 [InlineKeyboardButton("⬅️ Orqaga", callback_data="A_MANAGE")],
             ])
@@ -858,25 +2950,100 @@ async def cb_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await q.message.reply_text("🖼 Yangi rasm yuboring (photo):", reply_markup=back_to_admin_inline())
                 return
 
+            if field == "stock":
+                p = product_by_id(int(pid))
+                if not p:
+                    await q.message.reply_text("Mahsulot topilmadi.", reply_markup=back_to_admin_inline())
+                    return
+                context.user_data["state"] = A_EDIT_STOCK
+                st = stock_text(int(pid)) or "📦 Qoldiq kuzatilmaydi (cheklanmagan)"
+                if p[3] and p[4]:
+                    hint = f"O‘lcham=son ko‘rinishida kiriting. Masalan: {', '.join(x.strip() + '=10' for x in p[4].split(',') if x.strip())}"
+                else:
+                    hint = "Sonini kiriting. Masalan: 25"
+                await q.message.reply_text(
+                    f"{st}\n\n{hint}\nKuzatishni o‘chirish uchun: -",
+                    reply_markup=back_to_admin_inline()
+                )
+                return
+
         if data.startswith("A_DEL_DO|"):
             pid = int(data.split("|")[1])
             cur.execute("DELETE FROM products WHERE id=?", (pid,))
             cur.execute("DELETE FROM cart WHERE product_id=?", (pid,))
+            cur.execute("DELETE FROM media WHERE product_id=?", (pid,))
+            cur.execute("DELETE FROM stock WHERE product_id=?", (pid,))
             conn.commit()
+            catalog_invalidate()
+            stock_counter.set_product(pid, None)
             clear_state(context)
             await q.message.reply_text("✅ Mahsulot o‘chirildi.", reply_markup=back_to_admin_inline())
             return
 
         if data == "A_BC":
             clear_state(context)
-            context.user_data["state"] = A_BC_TEXT
-            await q.message.reply_text("📢 Broadcast uchun matn kiriting (yoki rasm yuboring):", reply_markup=back_to_admin_inline())
+            await q.message.reply_text("📢 Kimga yuboramiz? (qavsda — qabul qiluvchilar soni)", reply_markup=bc_segments_inline())
+            return
+
+        if data == "A_BC_PROD":
+            await q.message.reply_text("📦 Qaysi mahsulotni buyurtma qilganlarga?", reply_markup=bc_products_inline())
+            return
+
+        if data.startswith("A_BC_SEG|"):
+            parts = data.split("|")
+            await admin_bc_pick_segment(q, context, parts[1], parts[2] if len(parts) > 2 else None)
+            return
+
+        if data == "A_IMPORT":
+            clear_state(context)
+            context.user_data["state"] = A_IMPORT_FILE
+            await q.message.reply_text(
+                "📥 CSV yoki XLSX fayl yuboring.\n\n"
+                "Ustunlar: sku, name, price, sizes, stock\n"
+                "• sku — majburiy, shu bo‘yicha yangilanadi\n"
+                "• sizes — vergul bilan (bo‘sh — o‘lchamsiz)\n"
+                "• stock — 25 yoki 10x10=5, 20x20=3 (bo‘sh — o‘zgarmaydi, - — cheklanmagan)\n\n"
+                "Avval sinov natijasi ko‘rsatiladi, keyin tasdiqlaysiz.",
+                reply_markup=back_to_admin_inline()
+            )
+            return
+
+        if data.startswith("A_IMPORT_DO|"):
+            await admin_import_apply(q, context, data.split("|", 1)[1])
+            return
+
+        if data.startswith("A_IMPORT_NO|"):
+            await admin_import_cancel(q, context, data.split("|", 1)[1])
+            return
+
+        if data == "A_EXPORT":
+            await admin_export_orders(q, context)
+            return
+
+        if data == "A_BK":
+            await admin_backups(q, context)
+            return
+
+        if data == "A_BK_NOW":
+            await admin_backup_now(q, context)
+            return
+
+        if data.startswith("A_BK_RS|"):
+            await admin_backup_restore(q, context, data.split("|", 1)[1])
             return
 
         if data == "A_STATS":
             await send_stats(q, context)
             return
 
+        if data == "A_STATS_IMG":
+            await send_stats_chart(q, context)
+            return
+
+        if data.startswith("A_STATS_P|"):
+            await send_sales_period(q, context, data.split("|")[1])
+            return
+
         return
 
     # ---------- USER ----------
@@ -900,6 +3067,9 @@ async def cb_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # U_SIZE|pid|size|origin -> tanlagandan keyin son so'raymiz
         _, pid, size, origin = data.split("|", 3)
         pid = int(pid)
+        if stock_counter.available(pid, size) == 0:
+            await q.message.reply_text("❌ Bu mahsulot omborda tugagan.", reply_markup=back_btn())
+            return
         context.user_data["pending_pid"] = pid
         context.user_data["pending_size"] = size
         context.user_data["pending_origin"] = origin
@@ -920,8 +3090,10 @@ async def cb_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.message.reply_text("🧹 Savatcha tozalandi.", reply_markup=back_btn())
         return
 
-    if data == "U_CONFIRM":
-        await confirm_order(uid, context, q.message)
+    if data == "U_CONFIRM" or data.startswith("U_CONFIRM|"):
+        # eski xabarlardagi tokensiz tugma ham ishlaydi (idempotentsiz)
+        token = data.split("|", 1)[1] if "|" in data else None
+        await confirm_order(uid, context, q.message, token=token)
         return
 
 # ----------------- User BACK handler -----------------
@@ -981,21 +3153,366 @@ async def handle_user_back(q, context: ContextTypes.DEFAULT_TYPE):
     # fallback
     await q.message.reply_text("🏠 Bosh menyu", reply_markup=main_menu_kb(False))
 
-# ----------------- Main -----------------
-def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+# ----------------- Update de-duplication -----------------
+# restart/qayta yetkazishda bir xil update_id ikkinchi marta ishlanmaydi
+seen_updates = TTLCache(20000, 600)
+
+async def dedup_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if seen_updates.get(update.update_id):
+        log.info("Takroriy update o‘tkazib yuborildi: %s", update.update_id)
+        raise ApplicationHandlerStop
+    seen_updates.set(update.update_id, True)
+
+# ----------------- Flood control + coalescing -----------------
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))  # token/soniya
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "8"))
+# shu oraliqda bir xil so'rov qayta render qilinmaydi
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.0"))
+
+# faqat shu tugmalar birlashtiriladi (ism, son, admin matnlari emas)
+MENU_TEXTS = frozenset({"🛍 Mahsulotlar", "🛒 Savatcha", "ℹ️ Info", "📞 Contact", "👑 Admin panel"})
+
+class TokenBucket:
+    __slots__ = ("tokens", "ts", "warned")
+
+    def __init__(self):
+        self.tokens = float(FLOOD_BURST)
+        self.ts = time_mono()
+        self.warned = False
+
+    def take(self) -> bool:
+        now = time_mono()
+        self.tokens = min(FLOOD_BURST, self.tokens + (now - self.ts) * FLOOD_RATE)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.warned = False
+            return True
+        return False
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("cancel", cancel))
+flood_buckets = TTLCache(50000, 600)
+recent_requests = TTLCache(50000, COALESCE_WINDOW)
 
-    app.add_handler(CallbackQueryHandler(cb_router))
+def request_key(update: Update):
+    uid = update.effective_user.id
+    q = update.callback_query
+    if q:
+        # bir xil post dagi takroriy bosish; ketma-ket "Orqaga" lar har xil postlarda
+        return (uid, q.message.message_id if q.message else None, q.data)
+    text = update.message.text if update.message else None
+    if text in MENU_TEXTS:
+        return (uid, text)
+    return None
+
+async def _ack(update: Update, text: str | None = None):
+    q = update.callback_query
+    if not q:
+        return
+    try:
+        await q.answer(text)
+    except Exception:
+        pass
+
+def flood_guard(handler):
+    # menu_handler/cb_router oldidan: per-user token bucket + bir xil so'rovlarni birlashtirish
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if not user or is_admin(user.id):
+            return await handler(update, context)
+
+        key = request_key(update)
+        # handlerlar ketma-ket ishlaydi: takror faqat tugagandan keyingi oynada keladi
+        if key and recent_requests.get(key):
+            await _ack(update)
+            return None
+
+        bucket = flood_buckets.get(user.id)
+        if bucket is None:
+            bucket = TokenBucket()
+            flood_buckets.set(user.id, bucket)
+        if not bucket.take():
+            if update.callback_query:
+                await _ack(update, "⏳ Juda tez. Biroz kuting.")
+            elif not bucket.warned and update.message:
+                bucket.warned = True
+                await update.message.reply_text("⏳ Juda tez. Biroz kuting.")
+            return None
+
+        try:
+            return await handler(update, context)
+        finally:
+            if key:
+                recent_requests.set(key, True)
+    return wrapper
+
+# ----------------- Lifecycle (graceful shutdown) -----------------
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "20"))
+
+class Lifecycle:
+    def __init__(self):
+        self.stopping = asyncio.Event()
+        self.tasks = set()
+
+    def track(self, handler):
+        # handler alohida task da ishlaydi: deadline o'tsa faqat o'zi bekor qilinadi
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            task = asyncio.ensure_future(handler(update, context))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # shield: tashqi bekor qilishda ichki task davom etadi (cancelled() False) —
+                # faqat drain bekor qilgan handler yutiladi (Task.cancelling() 3.11+ kerak emas)
+                if task.cancelled():
+                    log.warning("Handler %s drain deadline sababli bekor qilindi", handler.__name__)
+                    return None
+                raise
+        return wrapper
+
+    async def drain(self, timeout: float):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.tasks and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self.tasks:
+            log.warning("Drain deadline: %s ta handler bekor qilinmoqda", len(self.tasks))
+            for t in list(self.tasks):
+                t.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def begin_shutdown(self, app):
+        if self.stopping.is_set():
+            # ikkinchi signal — kutmasdan to'xtatamiz
+            app.stop_running()
+            return
+        self.stopping.set()
+        log.info("Shutdown: yangi update lar qabul qilinmaydi, handlerlar kutilmoqda (%.0fs)", DRAIN_TIMEOUT)
+        if app.updater and app.updater.running:
+            await app.updater.stop()
+        await self.drain(DRAIN_TIMEOUT)
+        app.stop_running()
 
-    app.add_handler(MessageHandler(filters.CONTACT, contact_handler))
-    app.add_handler(MessageHandler(filters.PHOTO, admin_photo_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, menu_handler))
+lifecycle = Lifecycle()
+
+def checkpoint_db():
+    try:
+        conn.commit()
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except Exception:
+        log.exception("WAL checkpointda xatolik")
+
+async def post_init(app):
+    # signal lar faqat update qabul qiluvchi jarayonda (workerlarni master to'xtatadi)
+    if app.updater is not None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, lambda: asyncio.ensure_future(lifecycle.begin_shutdown(app)))
+            except (NotImplementedError, RuntimeError):
+                # Windows: KeyboardInterrupt ni run_polling o'zi ushlaydi
+                pass
+    await resume_broadcasts(app)
+    log.info("Ishga tushish: %.0f ms (importdan update qabul qilishgacha)", (time_mono() - BOOT_T0) * 1000)
+
+async def post_stop(app):
+    # run_polling KeyboardInterrupt orqali to'xtaganda ham broadcast lar pauzaga o'tsin
+    lifecycle.stopping.set()
+
+def close_db():
+    # ochilmagan ulanishni yopish uchun ochmaymiz
+    if conn.created:
+        checkpoint_db()
+        conn.close()
+    if store.created:
+        store.close()
+
+async def post_shutdown(app):
+    close_db()
+    log.info("DB yopildi (WAL checkpoint bajarildi)")
+
+# ----------------- Multi-worker (hash ring) -----------------
+class HashRing:
+    # consistent hashing: WORKERS o'zgarsa foydalanuvchilarning ozgina qismi ko'chadi
+    def __init__(self, nodes, replicas: int = 160):
+        self._ring = sorted(
+            (self._hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def node_for(self, key) -> int:
+        i = bisect.bisect(self._keys, self._hash(str(key))) % len(self._keys)
+        return self._ring[i][1]
+
+def update_shard_key(update: Update) -> int:
+    # bitta foydalanuvchining barcha update lari bitta workerga (tartib + user_data)
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return update.update_id
+
+def worker_entry(worker_id: int, queue):
+    # workerni master to'xtatadi (None signal), o'zi signalga javob bermaydi
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(run_worker(worker_id, queue))
+
+async def run_worker(worker_id: int, queue):
+    app = build_app(with_updater=False)
+    loop = asyncio.get_running_loop()
+    async with app:
+        await post_init(app)
+        await app.start()
+        log.info("Worker #%s ishga tushdi (pid=%s)", worker_id, os.getpid())
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(json.loads(data), app.bot))
+        lifecycle.stopping.set()
+        await lifecycle.drain(DRAIN_TIMEOUT)
+        await app.stop()
+        await post_stop(app)
+    await post_shutdown(app)
+
+async def run_master():
+    import multiprocessing
+
+    # spawn: har worker o'z sqlite ulanishini ochadi (fork qilingan ulanish ishlatilmaydi)
+    mp = multiprocessing.get_context("spawn")
+    queues = [mp.Queue(maxsize=1000) for _ in range(WORKERS)]
+    procs = [mp.Process(target=worker_entry, args=(i, queues[i]), name=f"worker-{i}") for i in range(WORKERS)]
+    for p in procs:
+        p.start()
+    ring = HashRing(range(WORKERS))
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
 
-    log.info("Bot running. DB at %s | Admins: %s", DB_PATH, ADMIN_IDS)
-    app.run_polling(close_loop=False)
+    update_queue = asyncio.Queue()
+    updater = Updater(Bot(TOKEN), update_queue)
+
+    async def forward(update):
+        q = queues[ring.node_for(update_shard_key(update))]
+        await loop.run_in_executor(None, q.put, update.to_json())
+
+    async with updater:
+        if WEBHOOK_URL:
+            await updater.start_webhook(
+                listen="0.0.0.0", port=PORT, url_path="tg", webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET or None,
+            )
+        else:
+            await updater.start_polling()
+        log.info("Master: %s ta worker, %s", WORKERS, "webhook" if WEBHOOK_URL else "polling")
+
+        stop_wait = asyncio.ensure_future(stop.wait())
+        while not stop.is_set():
+            get_next = asyncio.ensure_future(update_queue.get())
+            done, _ = await asyncio.wait({get_next, stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+            if get_next in done:
+                await forward(get_next.result())
+            else:
+                get_next.cancel()
+
+        log.info("Master: to'xtatilmoqda, qabul qilingan update lar workerlarga uzatiladi")
+        await updater.stop()
+        while not update_queue.empty():
+            await forward(update_queue.get_nowait())
+
+    for q in queues:
+        q.put(None)
+    for p in procs:
+        await loop.run_in_executor(None, p.join, DRAIN_TIMEOUT + 10)
+        if p.is_alive():
+            log.warning("%s deadline ichida to'xtamadi, terminate", p.name)
+            p.terminate()
+    close_db()
+
+# ----------------- Main -----------------
+async def bootstrap_job(context: ContextTypes.DEFAULT_TYPE):
+    media_warmup()
+    # EXISTS — jadvallarni sanamaydi, birinchi qatorda to'xtaydi
+    cur.execute("""
+        SELECT NOT EXISTS (SELECT 1 FROM daily_sales)
+           AND (EXISTS (SELECT 1 FROM orders) OR EXISTS (SELECT 1 FROM arch.orders))
+    """)
+    if cur.fetchone()[0]:
+        await rollup_full_rebuild_job(context)
+
+def build_app(with_updater: bool = True):
+    # application factory: konfiguratsiya shu yerda tekshiriladi, DB birinchi so'rovda ochiladi
+    load_config()
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .persistence(StorePersistence(store))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    track = lifecycle.track
+
+    app.add_handler(TypeHandler(Update, dedup_updates), group=-1)
+
+    app.add_handler(CommandHandler("start", track(start)))
+    app.add_handler(CommandHandler("cancel", track(cancel)))
+
+    app.add_handler(CallbackQueryHandler(track(flood_guard(cb_router))))
+
+    app.add_handler(MessageHandler(filters.CONTACT, track(contact_handler)))
+    app.add_handler(MessageHandler(filters.PHOTO, track(admin_photo_handler)))
+    app.add_handler(MessageHandler(filters.Document.ALL, track(admin_document_handler)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, track(flood_guard(menu_handler))))
+
+    # davriy job lar har workerda rejalashtiriladi, job_lease bittasiga ruxsat beradi
+    # rollup har kecha oxirgi kunlar bo'yicha tekshiriladi; bo'sh bo'lsa bootstrap_job to'liq to'ldiradi
+    app.job_queue.run_daily(rollup_rebuild_job, time=time(hour=3, tzinfo=timezone.utc), name="rollup_rebuild")
+    # DB ishi ishga tushish yo'lida emas: polling boshlangach bajariladi
+    app.job_queue.run_once(bootstrap_job, when=1, name="bootstrap")
+    app.job_queue.run_repeating(media_check_job, interval=600, first=30, name="media_check")
+    app.job_queue.run_repeating(bc_resume_job, interval=60, first=BC_LOCK_TTL, name="bc_resume")
+    app.job_queue.run_repeating(cart_reminder_job, interval=600, first=120, name="cart_reminder")
+    app.job_queue.run_repeating(backup_job, interval=BACKUP_EVERY_H * 3600, first=300, name="backup")
+    app.job_queue.run_daily(archive_job, time=time(hour=4, tzinfo=timezone.utc), name="archive")
+    return app
+
+def main():
+    load_config()
+    if VACUUM_CONVERT:
+        convert_auto_vacuum()
+    if WORKERS > 1:
+        if STATE_BACKEND != "sqlite":
+            raise ValueError("WORKERS>1 uchun STATE_BACKEND=sqlite kerak")
+        log.info("Bot running (multi-worker). DB at %s | Admins: %s", DB_PATH, sorted(ADMIN_IDS))
+        asyncio.run(run_master())
+        return
+
+    app = build_app()
+    log.info("Bot running. DB at %s | Admins: %s", DB_PATH, sorted(ADMIN_IDS))
+    # signal lar post_init da o'rnatiladi (drain + deadline uchun)
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0", port=PORT, url_path="tg", webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None, close_loop=False, stop_signals=None,
+        )
+    else:
+        app.run_polling(close_loop=False, stop_signals=None)
 
 if __name__ == "__main__":
     main()